@@ -6,21 +6,52 @@ import re
 import json 
 import os 
 import html 
+import hashlib
+import bisect
+import unicodedata
 from dotenv import load_dotenv
 from datetime import datetime, time, date, timedelta
 # --- IMPORTACIÓN NUEVA PARA VELOCIDAD ---
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import io # Para manejo de buffers de memoria (Excel)
+import xlsxwriter
 import time as time_lib
+import threading
+from types import MappingProxyType
+from collections import deque
 from gspread.exceptions import APIError
 
+from sheets_api import (
+    QuotaAwareHTTPClient,
+    background_priority,
+    get_quota_stats,
+    claim_flights,
+    resolve_flight,
+    single_flight,
+    single_flight_many,
+    get_spreadsheet,
+    get_worksheet,
+    get_worksheets,
+    prefetch_ranges,
+)
+
 # --- IMPORTACIÓN DE CONFIGURACIÓN ---
 try:
     from form_config import (
         GOOGLE_SHEET_ID,
         FORM_CONFIG, 
         validate_data,
-        get_options_from_sheet
+        get_options_from_sheet,
+        SCHEMA_PLANS,
+        EMPTY_SCHEMA_PLAN,
+        with_view_columns,
+        dump_schema_plans,
+        parse_expression,
+        load_listas_snapshot,
+        LISTAS_SHEET_NAME,
+        HOJA_PARTE_DIARIO,
+        RANGOS_PARTE_DIARIO,
     )
 except ImportError:
     st.error("Error crítico: No se pudo encontrar el archivo 'form_config.py'. Asegúrate de que esté en la misma carpeta.")
@@ -50,6 +81,10 @@ def get_sheet_edit_data(sheet_name):
     """Obtiene los datos de la fila que se está editando en una hoja."""
     return st.session_state.get(f"edit_data_{sheet_name}", None)
 
+def rerun_sheet():
+    """Re-ejecuta solo el fragmento de la hoja (cambios de modo). Dentro de un run completo, toda la app."""
+    st.rerun(scope="app" if st.session_state.get("full_run_in_progress") else "fragment")
+
 # --- RENDERIZADO DE CAMPOS ---
 def _render_form_fields(gc: gspread.Client, sheet_name: str, existing_data: dict = None):
     form_config = FORM_CONFIG.get(sheet_name, {})
@@ -146,7 +181,7 @@ def _render_form_fields(gc: gspread.Client, sheet_name: str, existing_data: dict
     return data_to_submit
 
 # --- FORMULARIOS ---
-def show_add_form(gc: gspread.Client, selected_sheet: str, all_columns: list, clear_cache_func):
+def show_add_form(gc: gspread.Client, selected_sheet: str, all_columns: list, sync_cache_func):
     st.markdown(f"#### ➕ Nuevo Registro en: {selected_sheet}")
     st.info("Completá los datos a continuación.")
     
@@ -163,8 +198,7 @@ def show_add_form(gc: gspread.Client, selected_sheet: str, all_columns: list, cl
 
         try:
             with st.spinner("Guardando..."):
-                sh = gc.open_by_key(GOOGLE_SHEET_ID)
-                worksheet = sh.worksheet(selected_sheet)
+                worksheet = get_worksheet(get_spreadsheet(gc, GOOGLE_SHEET_ID), selected_sheet)
                 new_row = []
                 for col_name in all_columns:
                     value = data_to_submit.get(col_name)
@@ -177,9 +211,8 @@ def show_add_form(gc: gspread.Client, selected_sheet: str, all_columns: list, cl
                 # Usamos row=2 para forzar la posición superior.
                 worksheet.insert_rows([new_row], row=2, value_input_option='USER_ENTERED')
             
-            # Limpieza agresiva de caché para asegurar que se vea el cambio
-            st.cache_data.clear()
-            st.cache_resource.clear()
+            # Reflejamos la fila nueva en la caché sin volver a descargar la hoja
+            sync_cache_func(gc, selected_sheet, "insert", row_values=new_row)
 
             st.success("✅ Registro guardado. Se ordenó insertar en la FILA 2.")
             
@@ -201,9 +234,9 @@ def show_add_form(gc: gspread.Client, selected_sheet: str, all_columns: list, cl
 
     if st.button("Cancelar", key=f"cancel_add_{selected_sheet}"):
         set_sheet_mode(selected_sheet, "view")
-        st.rerun()
+        rerun_sheet()
 
-def show_edit_form(gc: gspread.Client, row_data: dict, selected_sheet: str, all_columns: list, clear_cache_func):
+def show_edit_form(gc: gspread.Client, row_data: dict, selected_sheet: str, all_columns: list, sync_cache_func):
     st.markdown(f"#### ✏️ Editando Registro en: {selected_sheet}")
     id_column_name = all_columns[0]
     id_value = row_data.get(id_column_name)
@@ -229,10 +262,9 @@ def show_edit_form(gc: gspread.Client, row_data: dict, selected_sheet: str, all_
 
         try:
             with st.spinner("Actualizando..."):
-                sh = gc.open_by_key(GOOGLE_SHEET_ID)
-                worksheet = sh.worksheet(selected_sheet)
-                cell = worksheet.find(id_value, in_column=1)
-                if not cell:
+                worksheet = get_worksheet(get_spreadsheet(gc, GOOGLE_SHEET_ID), selected_sheet)
+                row_number = locate_sheet_row(worksheet, selected_sheet, id_value)
+                if not row_number:
                     st.error("No se encontró la fila original.")
                     return
 
@@ -244,11 +276,11 @@ def show_edit_form(gc: gspread.Client, row_data: dict, selected_sheet: str, all_
                     elif value is None: value = ""
                     updated_row.append(str(value))
                 
-                range_to_update = f"A{cell.row}:{gspread.utils.rowcol_to_a1(cell.row, len(all_columns))}"
+                range_to_update = f"A{row_number}:{gspread.utils.rowcol_to_a1(row_number, len(all_columns))}"
                 worksheet.update(range_to_update, [updated_row], value_input_option='USER_ENTERED')
             
             st.success("¡Actualizado!")
-            clear_cache_func()
+            sync_cache_func(gc, selected_sheet, "update", id_value=id_value, row_values=updated_row)
             set_sheet_mode(selected_sheet, "view")
             st.rerun()
 
@@ -257,7 +289,7 @@ def show_edit_form(gc: gspread.Client, row_data: dict, selected_sheet: str, all_
 
     if st.button("Cancelar Edición", key=f"cancel_edit_{selected_sheet}"):
         set_sheet_mode(selected_sheet, "view")
-        st.rerun()
+        rerun_sheet()
 
 # --- CONFIGURACIÓN Y CARGA ---
 st.set_page_config(layout="wide") 
@@ -354,7 +386,7 @@ def get_gspread_client():
             return None
     
     try:
-        return gspread.service_account_from_dict(creds_dict, scopes=SCOPES)
+        return gspread.service_account_from_dict(creds_dict, scopes=SCOPES, http_client=QuotaAwareHTTPClient)
     except Exception as e:
         st.error(f"Error de autenticación: {e}")
         st.stop()
@@ -363,7 +395,7 @@ def get_gspread_client():
 def _clean_headers(headers):
     counts = {}
     new_headers = []
-    for header in map(str.strip, headers):
+    for header in (str(h).strip() for h in headers):
         counts[header] = counts.get(header, 0) + 1
         new_headers.append(f"{header}_{counts[header]}" if counts[header] > 1 else header)
     return new_headers
@@ -371,106 +403,1580 @@ def _clean_headers(headers):
 # --- CARGA DE DATOS (OPTIMIZADA) ---
 @st.cache_data(ttl=3600) # Cache de 1 hora para evitar muchas llamadas a la API
 def get_available_sheets(_gc: gspread.Client):
-    """Obtiene la lista de hojas disponibles con reintentos automáticos."""
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            sh = _gc.open_by_key(GOOGLE_SHEET_ID)
-            worksheets = sh.worksheets()
-            # Filtramos solo las hojas que nos interesan y existen
-            valid_sheets = [ws.title for ws in worksheets if ws.title in VISTA_COLUMNAS_POR_HOJA]
-            return valid_sheets
-        except APIError as e:
-            if attempt < max_retries - 1:
-                sleep_time = 2 ** attempt # Exponential backoff: 1s, 2s, 4s...
-                time_lib.sleep(sleep_time)
-                continue
-            else:
-                # Si fallan todos los intentos, mostramos el error pero no cacheamos el fallo
-                raise e 
-        except Exception as e:
-            st.error(f"Error al obtener lista de hojas: {e}")
-            return []
+    """Obtiene la lista de hojas disponibles (los reintentos los hace QuotaAwareHTTPClient)."""
+    try:
+        worksheets = get_worksheets(get_spreadsheet(_gc, GOOGLE_SHEET_ID))
+        # Filtramos solo las hojas que nos interesan y existen
+        valid_sheets = [title for title in worksheets if title in VISTA_COLUMNAS_POR_HOJA]
+        return valid_sheets
+    except APIError:
+        # Si fallan todos los reintentos, propagamos el error para no cachear el fallo
+        raise
+    except Exception as e:
+        st.error(f"Error al obtener lista de hojas: {e}")
+        return []
 
-def _process_single_sheet(sheet_name, ws_data, vista_cols):
-    """Procesa los datos crudos de una hoja y devuelve el diccionario estructurado con tipos correctos."""
+@st.cache_resource
+def get_schema_plans():
+    """Plan de esquema por hoja: el que form_config compila al importar, más VISTA_COLUMNAS_POR_HOJA."""
+    return with_view_columns(SCHEMA_PLANS, VISTA_COLUMNAS_POR_HOJA)
+
+def _schema_plan(sheet_name):
+    return get_schema_plans().get(sheet_name, EMPTY_SCHEMA_PLAN)
+
+def _view_columns(sheet_name):
+    return _schema_plan(sheet_name)["view"]
+
+def _build_type_projection(sheet_name, columns):
+    """Lista de expresiones de conversión de tipos (fechas, numéricos) tomadas del plan de la hoja."""
+    casts = _schema_plan(sheet_name)["casts"]
+    return [casts.get(col_name, pl.col(col_name)) for col_name in columns]
+
+def _apply_categoricals(sheet_name, df):
+    """
+    Pasa las columnas select del plan a pl.Enum (dominio fijo de FORM_CONFIG) o
+    pl.Categorical (opciones de LISTAS). Si aparece un valor fuera del dominio
+    fijo, esa columna queda como Categorical en vez de fallar.
+    """
+    exprs = []
+    for col_name, domain in _schema_plan(sheet_name)["categoricals"].items():
+        if df.schema.get(col_name) != pl.String:
+            continue
+        dtype = pl.Categorical
+        if domain is not None:
+            categories = list(dict.fromkeys([*domain, ""]))
+            if df.get_column(col_name).drop_nulls().is_in(categories).all():
+                dtype = pl.Enum(categories)
+        exprs.append(pl.col(col_name).cast(dtype))
+    return df.with_columns(exprs) if exprs else df
+
+def _is_categorical(dtype):
+    return isinstance(dtype, (pl.Enum, pl.Categorical))
+
+# --- CARGA TIPADA (VALORES SIN FORMATO) ---
+# Con CARGA_TIPADA=1 los valores se piden con UNFORMATTED_VALUE y fechas como
+# número de serie: los números llegan como números y las fechas como días
+# desde el 30/12/1899, sin depender del formato regional de la planilla.
+# Las columnas sin tipo en FORM_CONFIG se pasan a texto (sin el formato de
+# la celda: una fecha en una columna sin tipo se ve como su número de serie).
+CARGA_TIPADA = os.environ.get("CARGA_TIPADA", "0") == "1"
+SERIAL_1970 = 25569 # Número de serie de Sheets del 01/01/1970 (día 0 de pl.Date)
+
+def _value_render_params():
+    """Parámetros de values:get/batchGet según el modo de carga."""
+    if CARGA_TIPADA:
+        return {"valueRenderOption": "UNFORMATTED_VALUE", "dateTimeRenderOption": "SERIAL_NUMBER"}
+    return {}
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _as_text(value):
+    """Valor sin formato → texto, para las columnas que se muestran como string."""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def _build_typed_frame(sheet_name, headers, rows):
+    """
+    Arma el frame desde valores sin formato. Fechas y números salen directo del
+    valor numérico; solo las celdas que Sheets guarda como texto (p. ej. una fecha
+    tipeada con apóstrofo) pasan por la misma conversión que la carga normal.
+    """
+    columns = list(zip(*rows)) if rows else [()] * len(headers)
+    fields = _schema_plan(sheet_name)["fields"]
+    series = []
+    for col_name, values in zip(headers, columns):
+        kind = fields.get(col_name, {}).get("kind")
+        if kind is None:
+            series.append(pl.Series(col_name, [_as_text(v) for v in values], dtype=pl.Utf8))
+            continue
+        numbers = pl.Series("num", [v if _is_number(v) else None for v in values], dtype=pl.Float64)
+        texts = pl.Series("txt", [v if isinstance(v, str) else None for v in values], dtype=pl.Utf8)
+        if kind == "date":
+            typed = (pl.col("num").floor().cast(pl.Int32) - SERIAL_1970).cast(pl.Date)
+        else:
+            typed = pl.col("num").cast(pl.Int64, strict=False)
+        series.append(
+            pl.DataFrame([numbers, texts])
+            .select(pl.coalesce(typed, parse_expression(kind, pl.col("txt"))).alias(col_name))
+            .to_series()
+        )
+    return pl.DataFrame(series)
+
+def _fingerprint_values(ws_data, vista_cols):
+    """Huella del contenido crudo de la hoja (y de las columnas de vista) para detectar si cambió."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update("\x1f".join(vista_cols).encode())
+    for row in ws_data:
+        digest.update(b"\x1e")
+        digest.update("\x1f".join(map(str, row)).encode())
+    return digest.hexdigest()
+
+def _process_single_sheet(sheet_name, ws_data, vista_cols, previous=None, columns=None):
+    """
+    Procesa los datos crudos de una hoja y devuelve el diccionario estructurado con tipos correctos.
+    Si 'previous' (la entrada anterior de la hoja) tiene la misma huella, se reutilizan sus
+    frames e índice tal cual: solo se actualiza la fecha de descarga.
+    'columns' son todos los encabezados de la hoja cuando ws_data trae solo algunas columnas (carga proyectada).
+    """
     if not ws_data:
         return None
+
+    fingerprint = _fingerprint_values(ws_data, vista_cols)
+    if previous is not None and previous.get("fingerprint") == fingerprint:
+        reused = {key: value for key, value in previous.items() if key != "from_snapshot"}
+        reused["fetched_at"] = datetime.now()
+        return reused
     
     headers = _clean_headers(ws_data[0])
     rows = ws_data[1:]
     
-    # 1. Crear DataFrame base (todo string)
-    df_full = pl.DataFrame(rows, schema=headers, orient="row")
-    
-    # 2. Aplicar conversiones de tipos según FORM_CONFIG
-    # Obtenemos la config para esta hoja
-    # NOTA: FORM_CONFIG usa nombres de columnas "humanos", que coinciden con los headers del sheet
-    form_fields = FORM_CONFIG.get(sheet_name, {})
-    
-    projection = []
-    
-    for col_name in df_full.columns:
-        # Por defecto dejamos la columna tal cual
-        expr = pl.col(col_name)
+    if CARGA_TIPADA:
+        # Valores sin formato: los tipos salen directo de Sheets
+        df_full = _build_typed_frame(sheet_name, headers, rows)
+    else:
+        # 1. Crear DataFrame base (todo string)
+        df_full = pl.DataFrame(rows, schema=headers, orient="row")
         
-        # Buscamos si este col_name tiene config
-        if col_name in form_fields:
-            field_config = form_fields[col_name]
-            f_type = field_config.get("type")
-            f_validate = field_config.get("validate")
-            
-            # --- Conversión de FECHAS ---
-            if f_type == "date":
-                # Intentamos parsear DD/MM/YYYY. Si falla, queda null (strict=False)
-                # fill_null para mantener el string original si no parsea es dificil si cambiamos tipo.
-                # Mejor estrategia: cast a Date. Los errores serán null.
-                expr = pl.col(col_name).str.strptime(pl.Date, "%d/%m/%Y", strict=False)
-            
-            # --- Conversión de NUMÉRICOS ---
-            elif f_validate in ["numeric", "max_30", "rango_1_4", "cedula", "dni"]:
-                # Limpiamos puntos y comas para que "30.000" sea 30000 y casteamos
-                expr = pl.col(col_name).str.replace_all(r"[.,]", "").str.strip_chars().cast(pl.Int64, strict=False)
-        
-        projection.append(expr)
-        
-    # Aplicamos la proyección de tipos
-    try:
-        df_full = df_full.with_columns(projection)
-    except Exception as e:
-        st.warning(f"Error al convertir tipos en {sheet_name}: {e}")
+        # 2. Aplicar conversiones de tipos según FORM_CONFIG
+        try:
+            df_full = df_full.with_columns(_build_type_projection(sheet_name, df_full.columns))
+        except Exception as e:
+            st.warning(f"Error al convertir tipos en {sheet_name}: {e}")
+
+    # 3. Columnas select como Enum/Categorical (códigos enteros en vez de strings)
+    df_full = _apply_categoricals(sheet_name, df_full)
 
     col_vista = [c for c in vista_cols if c in df_full.columns]
-    return {"full": df_full, "view": df_full.select(col_vista)}
+    entry = _make_sheet_entry(df_full, col_vista, columns=columns)
+    # Solo las entradas armadas desde Sheets llevan huella; las parcheadas o de snapshot no
+    entry["fingerprint"] = fingerprint
+    return entry
+
+# --- CLAVE DE BÚSQUEDA NORMALIZADA ---
+# Al cargar cada hoja se arma, para cada columna de vista, su texto en
+# minúsculas y sin acentos, más una clave por fila con todas ellas juntas.
+# "Contiene texto" pasa a ser un contains literal sobre esas columnas, sin
+# regex ni casts por tecla.
+CLAVE_BUSQUEDA = "__buscar_todo"
+_SEPARADOR_BUSQUEDA = "\x1f" # No se puede tipear: un término nunca cruza de una columna a otra
+
+def _search_text(expr, dtype):
+    """Texto de búsqueda de una columna: como se ve en la tabla, en minúsculas y sin acentos."""
+    if dtype == pl.Date:
+        expr = expr.dt.strftime("%d/%m/%Y")
+    return (
+        expr.cast(pl.Utf8).fill_null("")
+        .str.to_lowercase()
+        .str.normalize("NFKD")
+        .str.replace_all(r"\p{Mn}+", "")
+    )
 
-@st.cache_data(show_spinner=False) # Sin TTL para que no recargue solo
-def load_sheet_data(_gc: gspread.Client, sheet_name: str):
-    """Carga los datos de una sola hoja."""
+def _build_search_frame(df_full, col_vista):
+    """Frame con una columna normalizada por columna de vista y la clave de fila CLAVE_BUSQUEDA."""
+    if not col_vista:
+        return pl.DataFrame()
+    search = df_full.select([_search_text(pl.col(c), df_full.schema[c]).alias(c) for c in col_vista])
+    return search.with_columns(pl.concat_str(search.columns, separator=_SEPARADOR_BUSQUEDA).alias(CLAVE_BUSQUEDA))
+
+def normalize_search_term(term):
+    """Normaliza lo que tipea el usuario igual que _search_text."""
+    folded = unicodedata.normalize("NFKD", term.lower())
+    return "".join(ch for ch in folded if not unicodedata.combining(ch))
+
+def search_mask(sheet_data, columns, term):
+    """Máscara booleana (alineada con 'full') de las filas que contienen 'term' en alguna de 'columns'."""
+    needle = normalize_search_term(term)
+    search = sheet_data["search"]
+    if set(columns) >= set(sheet_data["view_columns"]):
+        return search.get_column(CLAVE_BUSQUEDA).str.contains(needle, literal=True)
+    return search.select(
+        pl.any_horizontal([pl.col(c).str.contains(needle, literal=True) for c in columns])
+    ).to_series()
+
+def sheet_view(sheet_data):
+    """Vista de la hoja como LazyFrame sobre el frame compartido: no copia datos hasta el collect()."""
+    return sheet_data["full"].lazy().select(sheet_data["view_columns"])
+
+def _build_row_index(df_full):
+    """
+    Índice ID (primera columna) → número de fila física en la hoja.
+    El DataFrame respeta el orden de la hoja y la fila 1 son los encabezados,
+    así que la fila i del DataFrame es la fila i + 2 de Sheets.
+    """
+    if not df_full.columns:
+        return {}
+    row_index = {}
+    ids = df_full.get_column(df_full.columns[0]).cast(pl.Utf8).to_list()
+    for position, id_value in enumerate(ids):
+        # Igual que worksheet.find(): ante IDs repetidos gana la primera aparición
+        if id_value and id_value not in row_index:
+            row_index[id_value] = position + 2
+    return row_index
+
+def _make_sheet_entry(df_full, col_vista, fetched_at=None, columns=None):
+    """
+    Arma la entrada del almacén para una hoja: frame completo, columnas de vista, índice de filas y fecha de descarga.
+    La vista no se materializa: es una proyección perezosa del frame completo (ver sheet_view).
+    'columns' son todos los encabezados de la hoja; si 'full' trae menos, la entrada es "projected"
+    y la fila completa se pide a Sheets al seleccionarla (ver load_full_row).
+    """
+    columns = list(columns) if columns is not None else df_full.columns
+    return {
+        "full": df_full,
+        "columns": columns,
+        "projected": columns != df_full.columns,
+        "view_columns": list(col_vista),
+        "search": _build_search_frame(df_full, col_vista),
+        "row_index": _build_row_index(df_full),
+        "fetched_at": fetched_at or datetime.now(),
+    }
+
+# --- SNAPSHOTS EN DISCO (ARRANQUE EN CALIENTE) ---
+# Cada hoja procesada se guarda como Parquet (con su fecha de descarga en los
+# metadatos). Tras un reinicio o deploy se sirve el snapshot al instante y se
+# refresca desde Google en segundo plano.
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "snapshots"))
+
+def _snapshot_path(sheet_name):
+    return os.path.join(SNAPSHOT_DIR, re.sub(r"[^\w.-]+", "_", sheet_name) + ".parquet")
+
+def _schema_signature(sheet_name):
+    """Huella del plan de esquema de la hoja: si cambia (deploy con otro FORM_CONFIG), la huella guardada no sirve."""
+    plan = dump_schema_plans({sheet_name: _schema_plan(sheet_name)})
+    return hashlib.blake2b(plan.encode(), digest_size=16).hexdigest()
+
+def save_snapshot(sheet_name, sheet_data):
+    """Escribe el frame completo de la hoja en disco. Los errores se registran y no interrumpen la app."""
+    path = _snapshot_path(sheet_name)
+    # Temporal por hilo: el refresco de fondo y una sesión pueden guardar la misma hoja a la vez
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
     try:
-        sh = _gc.open_by_key(GOOGLE_SHEET_ID)
-        worksheet = sh.worksheet(sheet_name)
-        data = worksheet.get_all_values()
-        
-        return _process_single_sheet(
-            sheet_name, 
-            data, 
-            VISTA_COLUMNAS_POR_HOJA.get(sheet_name, [])
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        metadata = {
+            "sheet_name": sheet_name,
+            "fetched_at": sheet_data["fetched_at"].isoformat(),
+            "columns": json.dumps(sheet_data["columns"]),
+        }
+        if sheet_data.get("fingerprint"):
+            # Con la huella, la primera descarga tras un reinicio reutiliza estos frames si nada cambió
+            metadata["fingerprint"] = sheet_data["fingerprint"]
+            metadata["schema"] = _schema_signature(sheet_name)
+        sheet_data["full"].write_parquet(tmp_path, metadata=metadata)
+        # Reemplazo atómico: un lector nunca ve un archivo a medio escribir
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"No se pudo guardar el snapshot de '{sheet_name}': {e}")
+
+def load_snapshot(sheet_name):
+    """Lee el snapshot de la hoja y arma su entrada (marcada con 'from_snapshot'). Devuelve None si no hay."""
+    path = _snapshot_path(sheet_name)
+    if not os.path.exists(path):
+        return None
+    try:
+        metadata = pl.read_parquet_metadata(path)
+        df_full = pl.read_parquet(path)
+        fetched_at = datetime.fromisoformat(metadata["fetched_at"])
+        # Snapshots viejos no traen "columns": son de carga completa
+        columns = json.loads(metadata["columns"]) if "columns" in metadata else None
+    except Exception as e:
+        print(f"Snapshot ilegible de '{sheet_name}': {e}")
+        return None
+
+    col_vista = [c for c in _view_columns(sheet_name) if c in df_full.columns]
+    entry = _make_sheet_entry(df_full, col_vista, fetched_at, columns)
+    entry["from_snapshot"] = True
+    if "fingerprint" in metadata and metadata.get("schema") == _schema_signature(sheet_name):
+        entry["fingerprint"] = metadata["fingerprint"]
+    return entry
+
+# --- ALMACÉN DE HOJAS PROCESADAS (UNA ENTRADA POR HOJA) ---
+@st.cache_resource
+def _get_sheet_store():
+    """
+    Almacén compartido del proceso. Cada hoja se guarda por separado:
+    - "sheets": {nombre_hoja: entrada de solo lectura} con "full", "columns", "projected",
+      "view_columns", "search", "row_index", "fetched_at" (ver _make_sheet_entry), más
+      "fingerprint", "change_seq", "data_version" y, si vino de disco, "from_snapshot".
+    - "retired": entradas invalidadas, para reutilizarlas si el contenido no cambió.
+    - "versions": escrituras/invalidaciones por hoja (descarta refrescos que quedaron viejos).
+    - "data_versions": último "data_version" asignado por hoja (ver _put_sheet_entry).
+    - "changes" / "change_seq": registro de cambios por ID (ver REGISTRO DE CAMBIOS).
+    - "headers": fila 1 de cada hoja para la carga proyectada (ver _sheet_header_rows).
+    """
+    return {
+        "sheets": {}, "retired": {}, "versions": {}, "data_versions": {},
+        "changes": {}, "change_seq": {}, "headers": {}, "lock": threading.Lock(),
+    }
+
+def locate_sheet_row(worksheet, sheet_name: str, id_value):
+    """
+    Devuelve la fila física de 'id_value' usando el índice en caché. Solo se lee
+    la celda A de esa fila para confirmar; si no coincide (la hoja cambió por
+    fuera de la app) se recurre a worksheet.find().
+    """
+    id_value = str(id_value)
+    cached = _get_sheet_store()["sheets"].get(sheet_name)
+    row = cached["row_index"].get(id_value) if cached else None
+    if row is not None:
+        if str(worksheet.acell(f"A{row}").value or "") == id_value:
+            return row
+
+    cell = worksheet.find(id_value, in_column=1)
+    return cell.row if cell else None
+
+def invalidate_sheet(sheet_name: str):
+    """
+    Descarta solo la entrada de 'sheet_name'. El cliente, las listas de
+    LISTAS y las demás hojas siguen en caché, así el rerun posterior a un
+    guardado cuesta una sola descarga. La entrada queda en "retired" para
+    que la recarga la reutilice si el contenido no cambió.
+    """
+    store = _get_sheet_store()
+    with store["lock"]:
+        retired = store["sheets"].pop(sheet_name, None)
+        if retired is not None:
+            store["retired"][sheet_name] = retired
+        store["versions"][sheet_name] = store["versions"].get(sheet_name, 0) + 1
+
+def _previous_entry(store, sheet_name):
+    """Última entrada conocida de la hoja (vigente o invalidada), para comparar huellas."""
+    return store["sheets"].get(sheet_name) or store["retired"].get(sheet_name)
+
+def _is_reused(previous, sheet_data):
+    return previous is not None and previous["full"] is sheet_data["full"]
+
+def _put_sheet_entry(store, sheet_name, sheet_data):
+    """
+    Guarda la entrada de la hoja y registra qué filas cambiaron respecto de la
+    anterior (ver REGISTRO DE CAMBIOS). Se llama con store["lock"] tomado.
+    Cada frame "full" nuevo recibe un "data_version" propio (también las filas
+    sin ID, que el registro de cambios no ve). Devuelve la entrada anterior.
+    """
+    previous = _previous_entry(store, sheet_name)
+    if _is_reused(previous, sheet_data):
+        sheet_data["data_version"] = previous["data_version"]
+    else:
+        _record_changes(store, sheet_name, previous, sheet_data)
+        data_version = store["data_versions"].get(sheet_name, 0) + 1
+        store["data_versions"][sheet_name] = data_version
+        sheet_data["data_version"] = data_version
+    # Las sesiones reciben la misma entrada, de solo lectura: nadie copia ni modifica los frames
+    store["sheets"][sheet_name] = MappingProxyType(dict(sheet_data))
+    store["retired"].pop(sheet_name, None)
+    return previous
+
+def _store_sheet(sheet_name, sheet_data):
+    """Guarda la entrada y devuelve la versión de solo lectura que quedó en el almacén."""
+    store = _get_sheet_store()
+    with store["lock"]:
+        _put_sheet_entry(store, sheet_name, sheet_data)
+        return store["sheets"][sheet_name]
+
+# --- REGISTRO DE CAMBIOS POR HOJA (CDC) ---
+# Cada vez que cambia la entrada de una hoja se anota qué IDs (primera columna)
+# se insertaron, modificaron o eliminaron, con un número de secuencia por hoja.
+# Los consumidores (filtros, índices de búsqueda, agregados) guardan la última
+# secuencia que procesaron y piden solo lo posterior con get_sheet_changes().
+CAMBIOS_POR_HOJA = 50 # Cambios que se conservan por hoja
+
+def _keyed_row_hashes(df):
+    """ID (como texto) → hash de la fila completa. Ante IDs repetidos gana la primera aparición, igual que el índice de filas."""
+    id_col = df.columns[0]
+    # Enum y Categorical se comparan por texto: pasar de uno al otro no es un cambio de contenido
+    categorical_cols = [name for name, dtype in df.schema.items() if _is_categorical(dtype)]
+    hashed = df.with_columns(pl.col(categorical_cols).cast(pl.Utf8)) if categorical_cols else df
+    return (
+        df.select(pl.col(id_col).cast(pl.Utf8).alias("__id"), hashed.hash_rows().alias("__hash"))
+        .filter(pl.col("__id").is_not_null() & (pl.col("__id") != ""))
+        .unique("__id", keep="first", maintain_order=True)
+    )
+
+def diff_sheet_rows(old_df: pl.DataFrame, new_df: pl.DataFrame):
+    """Compara dos versiones de una hoja por ID y devuelve {"inserted", "updated", "deleted"} (listas de IDs)."""
+    if not old_df.columns or not new_df.columns:
+        return None
+    joined = _keyed_row_hashes(old_df).join(
+        _keyed_row_hashes(new_df), on="__id", how="full", coalesce=True, suffix="_new"
+    )
+    return {
+        "inserted": joined.filter(pl.col("__hash").is_null()).get_column("__id").to_list(),
+        "updated": joined.filter(
+            pl.col("__hash").is_not_null() & pl.col("__hash_new").is_not_null() & (pl.col("__hash") != pl.col("__hash_new"))
+        ).get_column("__id").to_list(),
+        "deleted": joined.filter(pl.col("__hash_new").is_null()).get_column("__id").to_list(),
+    }
+
+def _record_changes(store, sheet_name, previous, sheet_data):
+    """
+    Anota el cambio entre 'previous' y 'sheet_data' y numera la nueva entrada.
+    Sin entrada previa (o si el diff falla) se anota un "reset": los consumidores
+    deben reconstruir desde la tabla completa.
+    """
+    changes = None
+    if previous is not None:
+        try:
+            changes = diff_sheet_rows(previous["full"], sheet_data["full"])
+        except Exception as e:
+            print(f"No se pudo calcular el diff de '{sheet_name}': {e}")
+    if changes is not None and not any(changes.values()):
+        # Mismo contenido por ID (p. ej. solo cambió el orden): no hay nada que anotar
+        sheet_data["change_seq"] = previous.get("change_seq", 0)
+        return
+
+    seq = store["change_seq"].get(sheet_name, 0) + 1
+    store["change_seq"][sheet_name] = seq
+    log = store["changes"].setdefault(sheet_name, deque(maxlen=CAMBIOS_POR_HOJA))
+    log.append({
+        "seq": seq,
+        "at": datetime.now(),
+        "reset": changes is None,
+        "inserted": changes["inserted"] if changes else [],
+        "updated": changes["updated"] if changes else [],
+        "deleted": changes["deleted"] if changes else [],
+    })
+    sheet_data["change_seq"] = seq
+
+def get_sheet_changes(sheet_name: str, since: int = 0):
+    """
+    Cambios de 'sheet_name' posteriores a la secuencia 'since' (del más viejo al más nuevo).
+    Devuelve (cambios, última_secuencia). 'cambios' es None cuando no alcanzan para
+    actualizar en forma incremental (historia recortada o un reset en el medio).
+    """
+    store = _get_sheet_store()
+    with store["lock"]:
+        last = store["change_seq"].get(sheet_name, 0)
+        pending = [change for change in store["changes"].get(sheet_name, ()) if change["seq"] > since]
+    if since == last:
+        return [], last
+    if not pending or pending[0]["seq"] != since + 1 or any(change["reset"] for change in pending):
+        return None, last
+    return pending, last
+
+# --- ÍNDICE GLOBAL DE BÚSQUEDA (TODAS LAS HOJAS) ---
+# Índice invertido token → {(hoja, ID)} sobre la clave normalizada de cada
+# fila. Se alimenta del almacén: una hoja nueva se indexa completa y después
+# solo se re-tokenizan los IDs que informa get_sheet_changes().
+_TOKEN_RE = re.compile(r"[^\W_]+(?:[./-][^\W_]+)*")
+
+@st.cache_resource
+def _get_search_index():
+    """Índice compartido: postings por token, tokens por documento y última secuencia indexada por hoja."""
+    return {"postings": {}, "docs": {}, "seq": {}, "vocab": None, "lock": threading.Lock()}
+
+def tokenize(text):
+    """Tokens de un texto ya normalizado. '30.123.456' da '30', '123', '456' y '30123456'."""
+    tokens = set()
+    for match in _TOKEN_RE.findall(text):
+        parts = re.split(r"[./-]", match)
+        tokens.update(parts)
+        if len(parts) > 1:
+            tokens.add("".join(parts))
+    return tokens
+
+def query_terms(text):
+    """
+    Palabras de una búsqueda ya normalizada, como (partes, forma compacta).
+    '30.123.456' da (['30', '123', '456'], '30123456'); una palabra simple no tiene forma compacta.
+    """
+    terms = []
+    for match in _TOKEN_RE.findall(text):
+        parts = re.split(r"[./-]", match)
+        terms.append((parts, "".join(parts) if len(parts) > 1 else None))
+    return terms
+
+def _index_doc(index, doc, tokens):
+    _unindex_doc(index, doc)
+    if not tokens:
+        return
+    index["docs"][doc] = tokens
+    for token in tokens:
+        postings = index["postings"].get(token)
+        if postings is None:
+            postings = index["postings"][token] = set()
+            index["vocab"] = None
+        postings.add(doc)
+
+def _unindex_doc(index, doc):
+    for token in index["docs"].pop(doc, ()):
+        postings = index["postings"][token]
+        postings.discard(doc)
+        if not postings:
+            del index["postings"][token]
+            index["vocab"] = None
+
+def _set_search_doc(index, doc, key):
+    if key is None:
+        _unindex_doc(index, doc)
+    else:
+        _index_doc(index, doc, tokenize(key))
+
+def _search_keys(sheet_data):
+    if not sheet_data["view_columns"]:
+        return None
+    return sheet_data["search"].get_column(CLAVE_BUSQUEDA).to_list()
+
+def sync_index_with_store(index, row_values, set_doc):
+    """
+    Pone al día un índice derivado del almacén ({"docs", "seq", "lock", ...}).
+    Una hoja que el índice no conoce (o cuyo historial no alcanza) se procesa
+    completa; si no, solo los IDs que informa get_sheet_changes().
+    row_values(entrada) da un valor por fila de 'full' (None: la hoja no se indexa);
+    set_doc(índice, (hoja, ID), valor) indexa el documento, o lo quita si el valor es None.
+    """
+    store = _get_sheet_store()
+    with store["lock"]:
+        entries = list(store["sheets"].items())
+    with index["lock"]:
+        for sheet_name, sheet_data in entries:
+            seq = sheet_data.get("change_seq", 0)
+            indexed = index["seq"].get(sheet_name)
+            if indexed == seq:
+                continue
+            changes = None
+            if indexed is not None:
+                changes, _ = get_sheet_changes(sheet_name, since=indexed)
+            row_index = sheet_data["row_index"]
+            if changes is None:
+                for doc in [doc for doc in index["docs"] if doc[0] == sheet_name]:
+                    set_doc(index, doc, None)
+                ids = list(row_index)
+            else:
+                # Solo hasta la entrada que tenemos en mano; lo posterior entra en la próxima pasada
+                ids = list(dict.fromkeys(
+                    id_value
+                    for change in changes if change["seq"] <= seq
+                    for id_value in change["inserted"] + change["updated"] + change["deleted"]
+                ))
+            values = row_values(sheet_data) if ids else None
+            for id_value in ids:
+                # Los IDs eliminados ya no están en row_index: se quitan del índice
+                row = row_index.get(id_value)
+                set_doc(index, (sheet_name, id_value), values[row - 2] if values is not None and row is not None else None)
+            index["seq"][sheet_name] = seq
+    return index
+
+def sync_search_index():
+    """Pone el índice de búsqueda al día con el almacén. Sin cambios no hace nada; con cambios solo toca esos IDs."""
+    return sync_index_with_store(_get_search_index(), _search_keys, _set_search_doc)
+
+def _prefix_matches(index, token):
+    """Documentos con algún token que empiece por 'token' (búsqueda binaria sobre el vocabulario ordenado)."""
+    if index["vocab"] is None:
+        index["vocab"] = sorted(index["postings"])
+    vocab = index["vocab"]
+    docs = set()
+    for position in range(bisect.bisect_left(vocab, token), len(vocab)):
+        if not vocab[position].startswith(token):
+            break
+        docs |= index["postings"][vocab[position]]
+    return docs
+
+def _term_matches(index, parts, compact):
+    """Documentos que contienen la palabra: todas sus partes o, si es compuesta, su forma compacta."""
+    docs = None
+    for part in sorted(parts, key=len, reverse=True):
+        matches = _prefix_matches(index, part)
+        docs = matches if docs is None else docs & matches
+        if not docs:
+            break
+    if compact is not None:
+        # Un número con puntos tipado como Int64 solo se indexa compacto (30.123.456 → 30123456)
+        docs = docs | _prefix_matches(index, compact)
+    return docs
+
+def search_all_sheets(term):
+    """
+    Busca 'term' en todas las hojas indexadas: cada palabra debe aparecer (como
+    prefijo de algún token) en la fila. Devuelve {hoja: [IDs]} en el orden de la hoja.
+    """
+    terms = query_terms(normalize_search_term(term))
+    if not terms:
+        return {}
+    index = sync_search_index()
+    with index["lock"]:
+        docs = None
+        for parts, compact in sorted(terms, key=lambda term: len("".join(term[0])), reverse=True):
+            matches = _term_matches(index, parts, compact)
+            docs = matches if docs is None else docs & matches
+            if not docs:
+                return {}
+    hits = {}
+    for sheet_name, id_value in docs:
+        hits.setdefault(sheet_name, []).append(id_value)
+    store = _get_sheet_store()["sheets"]
+    for sheet_name, ids in hits.items():
+        row_index = store[sheet_name]["row_index"] if sheet_name in store else {}
+        ids.sort(key=lambda id_value: row_index.get(id_value, 0))
+    return hits
+
+# --- LEGAJO POR CREDENCIAL (LÍNEA DE TIEMPO) ---
+# Índice CRED. → {(hoja, ID)} sobre todas las hojas del almacén, mantenido con
+# sync_index_with_store igual que el de búsqueda. Con él, el legajo de una
+# persona se arma leyendo solo sus filas, sin filtrar hoja por hoja.
+COLUMNAS_CREDENCIAL = ("CRED.", "CREDENCIAL") # "CREDENCIAL" en CERTIFICADOS MEDICOS
+# Columnas que identifican a la persona: no suman al detalle de cada evento
+_COLUMNAS_PERSONA = {"N°", "GRADO", "APELLIDOS", "NOMBRES", "NOMBRES Y APELLIDOS", "Nombre y Apellido", "APELLIDO Y NOMBRE", *COLUMNAS_CREDENCIAL}
+
+@st.cache_resource
+def _get_cred_index():
+    """Índice compartido: documentos por credencial y credencial por documento."""
+    return {"creds": {}, "docs": {}, "seq": {}, "lock": threading.Lock()}
+
+def normalize_credential(value):
+    """Credencial solo con dígitos: '12.345', ' 12345 ' y 12345 dan '12345'."""
+    return re.sub(r"\D", "", str(value))
+
+def _credential_column(sheet_data):
+    return next((c for c in COLUMNAS_CREDENCIAL if c in sheet_data["full"].columns), None)
+
+def _cred_values(sheet_data):
+    col_name = _credential_column(sheet_data)
+    if col_name is None:
+        return None
+    # Mismo criterio que normalize_credential: CRED. viene como Int64 y CREDENCIAL como texto libre
+    return sheet_data["full"].get_column(col_name).cast(pl.Utf8).str.replace_all(r"\D", "").fill_null("").to_list()
+
+def _set_cred_doc(index, doc, cred):
+    previous = index["docs"].pop(doc, None)
+    if previous is not None:
+        docs = index["creds"][previous]
+        docs.discard(doc)
+        if not docs:
+            del index["creds"][previous]
+    if cred:
+        index["docs"][doc] = cred
+        index["creds"].setdefault(cred, set()).add(doc)
+
+def sync_cred_index():
+    """Pone el índice de credenciales al día con el almacén."""
+    return sync_index_with_store(_get_cred_index(), _cred_values, _set_cred_doc)
+
+def _event_date_column(sheet_data):
+    """Primera columna de vista con tipo fecha: es la fecha del evento en la línea de tiempo."""
+    schema = sheet_data["full"].schema
+    return next((c for c in sheet_data["view_columns"] if schema[c] == pl.Date), None)
+
+def _display_text(col_name, dtype):
+    expr = pl.col(col_name)
+    return expr.dt.strftime("%d/%m/%Y") if dtype == pl.Date else expr.cast(pl.Utf8)
+
+def _timeline_events(sheet_name, sheet_data, ids):
+    """Filas de 'ids' en la hoja como eventos: FECHA, HOJA, N° y DETALLE ("columna: valor · ...")."""
+    row_index = sheet_data["row_index"]
+    rows = sheet_data["full"][sorted(row_index[id_value] - 2 for id_value in ids if id_value in row_index)]
+    date_col = _event_date_column(sheet_data)
+    detail = [
+        pl.when(_display_text(c, rows.schema[c]).str.strip_chars() != "")
+        .then(pl.lit(f"{c}: ") + _display_text(c, rows.schema[c]))
+        for c in sheet_data["view_columns"] if c not in _COLUMNAS_PERSONA and c != date_col
+    ]
+    return rows.select(
+        (pl.col(date_col) if date_col else pl.lit(None, dtype=pl.Date)).alias("FECHA"),
+        pl.lit(sheet_name).alias("HOJA"),
+        pl.col(rows.columns[0]).cast(pl.Utf8).alias("N°"),
+        (pl.concat_str(detail, separator=" · ", ignore_nulls=True) if detail else pl.lit("")).alias("DETALLE"),
+    )
+
+def build_person_timeline(cred):
+    """Todos los eventos de la credencial 'cred' en las hojas cargadas, ordenados por fecha (los sin fecha al final)."""
+    index = sync_cred_index()
+    with index["lock"]:
+        docs = list(index["creds"].get(normalize_credential(cred), ()))
+    by_sheet = {}
+    for sheet_name, id_value in docs:
+        by_sheet.setdefault(sheet_name, []).append(id_value)
+
+    store = _get_sheet_store()["sheets"]
+    frames = [
+        _timeline_events(sheet_name, store[sheet_name], ids)
+        for sheet_name, ids in by_sheet.items() if sheet_name in store
+    ]
+    if not frames:
+        return pl.DataFrame(schema={"FECHA": pl.Date, "HOJA": pl.Utf8, "N°": pl.Utf8, "DETALLE": pl.Utf8})
+    return pl.concat(frames).sort(["FECHA", "HOJA"], nulls_last=True)
+
+def _fetch_sheets_batch(sh, sheet_names):
+    """
+    Descarga varias hojas con un solo values:batchGet (completas, o solo las
+    columnas de vista con CARGA_PROYECTADA). Devuelve [(nombre, filas, encabezados)];
+    'encabezados' es None cuando 'filas' ya trae todas las columnas.
+    """
+    if CARGA_PROYECTADA:
+        return _fetch_sheets_projected(sh, sheet_names)
+    return [(sheet_name, data, None) for sheet_name, data in _fetch_sheets_full(sh, sheet_names)]
+
+def _fetch_sheets_full(sh, sheet_names):
+    response = sh.values_batch_get(
+        [gspread.utils.absolute_range_name(name) for name in sheet_names],
+        params=_value_render_params(),
+    )
+    # Google devuelve los rangos en el mismo orden en que se pidieron;
+    # igual que get_all_values(), rellenamos las filas cortas con ""
+    return [
+        (sheet_name, gspread.utils.fill_gaps(value_range.get("values", [])))
+        for sheet_name, value_range in zip(sheet_names, response.get("valueRanges", []))
+    ]
+
+# --- CARGA PROYECTADA (SOLO COLUMNAS DE VISTA) ---
+# Con CARGA_PROYECTADA=1 se descargan solo la columna de ID y las de
+# VISTA_COLUMNAS_POR_HOJA, una columna por rango (majorDimension=COLUMNS).
+# En hojas anchas como DOTACION (44+ columnas) baja mucho lo transferido y
+# parseado. La fila completa se pide recién al seleccionarla (load_full_row).
+CARGA_PROYECTADA = os.environ.get("CARGA_PROYECTADA", "0") == "1"
+
+def _column_range(sheet_name, col_idx):
+    letter = re.sub(r"\d", "", gspread.utils.rowcol_to_a1(1, col_idx + 1))
+    return gspread.utils.absolute_range_name(sheet_name, f"{letter}:{letter}")
+
+def _sheet_header_rows(sh, store, sheet_names, refresh=False):
+    """Fila 1 (tal cual viene de Sheets) de cada hoja. Se cachea en el almacén; las que faltan se piden juntas."""
+    missing = [name for name in sheet_names if refresh or name not in store["headers"]]
+    if missing:
+        response = sh.values_batch_get(
+            [gspread.utils.absolute_range_name(name, "1:1") for name in missing],
+            params=_value_render_params(),
         )
+        for sheet_name, value_range in zip(missing, response.get("valueRanges", [])):
+            values = value_range.get("values", [])
+            store["headers"][sheet_name] = values[0] if values else []
+    return {name: store["headers"][name] for name in sheet_names}
+
+def _projected_positions(sheet_name, headers):
+    """Posiciones de las columnas a descargar: la de ID (primera) y las de vista, sin repetir."""
+    clean = _clean_headers(headers)
+    wanted = dict.fromkeys([clean[0]] + _view_columns(sheet_name))
+    return [clean.index(name) for name in wanted if name in clean]
+
+def _fetch_sheets_projected(sh, sheet_names):
+    """Como _fetch_sheets_full pero pidiendo solo las columnas de _projected_positions."""
+    store = _get_sheet_store()
+    results = {}
+    pending = list(sheet_names)
+    # Si una columna ya no empieza con el encabezado esperado (se insertaron o movieron
+    # columnas), se vuelven a leer los encabezados y se reintenta una vez
+    for refresh in (False, True):
+        if not pending:
+            break
+        headers = _sheet_header_rows(sh, store, pending, refresh=refresh)
+        plan = [(name, pos) for name in pending if headers[name] for pos in _projected_positions(name, headers[name])]
+        value_ranges = []
+        if plan:
+            response = sh.values_batch_get(
+                [_column_range(name, pos) for name, pos in plan],
+                params={"majorDimension": "COLUMNS", **_value_render_params()},
+            )
+            value_ranges = response.get("valueRanges", [])
+
+        fetched = {}
+        for (name, pos), value_range in zip(plan, value_ranges):
+            values = value_range.get("values", [])
+            fetched.setdefault(name, []).append((pos, values[0] if values else []))
+
+        stale = []
+        for name in pending:
+            raw_headers = headers[name]
+            columns = fetched.get(name, [])
+            if not raw_headers:
+                results[name] = ([], None)
+            elif any((column[0] if column else "") != raw_headers[pos] for pos, column in columns):
+                stale.append(name)
+            else:
+                clean = _clean_headers(raw_headers)
+                # Las columnas vienen sin las celdas vacías del final: las igualamos en largo
+                height = max((len(column) for _, column in columns), default=1) - 1
+                body = [column[1:] + [""] * (height - len(column) + 1) for _, column in columns]
+                rows = [list(row) for row in zip(*body)]
+                results[name] = ([[clean[pos] for pos, _ in columns]] + rows, clean)
+        pending = stale
+
+    if pending:
+        # La estructura sigue sin coincidir: esas hojas se descargan completas
+        for sheet_name, data in _fetch_sheets_full(sh, pending):
+            results[sheet_name] = (data, None)
+
+    return [(name, *results[name]) for name in sheet_names if name in results]
+
+@st.cache_data(ttl=600, max_entries=200, show_spinner=False)
+def _fetch_full_row(_gc: gspread.Client, sheet_name: str, id_value: str, row_number, version, fetched_at):
+    """
+    Valores de la fila completa de 'id_value'. Confirma el ID en la columna A y,
+    si no coincide (la hoja cambió por fuera de la app), la busca con find().
+    'version' y 'fetched_at' solo están para que una escritura o un refresco cambien la clave.
+    """
+    sh = get_spreadsheet(_gc, GOOGLE_SHEET_ID)
+
+    def read_row(row):
+        response = sh.values_get(gspread.utils.absolute_range_name(sheet_name, f"{row}:{row}"))
+        values = response.get("values", [])
+        return values[0] if values else []
+
+    values = read_row(row_number) if row_number else []
+    if not values or str(values[0]) != id_value:
+        cell = get_worksheet(sh, sheet_name).find(id_value, in_column=1)
+        if cell is None:
+            return None
+        values = read_row(cell.row)
+    return values
+
+def load_full_row(gc: gspread.Client, sheet_name: str, sheet_data: dict, id_value):
+    """
+    Fila completa (columna → valor tipado) de 'id_value', o None si no está.
+    Con carga proyectada se pide a Sheets en el momento; si no, sale del frame en memoria.
+    """
+    df_full = sheet_data["full"]
+    if not sheet_data.get("projected"):
+        # Buscamos por la primera columna de la vista, convertida a string para asegurar match
+        full_row = df_full.filter(pl.col(sheet_data["view_columns"][0]).cast(pl.Utf8) == str(id_value))
+        return None if full_row.is_empty() else full_row.row(0, named=True)
+
+    id_value = str(id_value)
+    version = _get_sheet_store()["versions"].get(sheet_name, 0)
+    values = _fetch_full_row(
+        gc, sheet_name, id_value, sheet_data["row_index"].get(id_value), version, sheet_data["fetched_at"]
+    )
+    if values is None:
+        return None
+    columns = sheet_data["columns"]
+    values = (list(values) + [""] * len(columns))[:len(columns)]
+    return _typed_row_frame(sheet_name, columns, values).row(0, named=True)
+
+# --- CARGA EN PARALELO ---
+MAX_WORKERS_CARGA = 6 # Igual al máximo de hojas seleccionables
+
+def _sheet_flight_key(sheet_name):
+    """Clave single-flight de la descarga de una hoja (compartida por sesiones, refrescos y precarga)."""
+    return ("hoja", GOOGLE_SHEET_ID, sheet_name)
+
+def _process_fetched_sheet(sheet_name, data, columns, start):
+    """Procesa y guarda una hoja ya descargada (en un hilo del pool). Devuelve (datos, segundos desde 'start')."""
+    previous = _previous_entry(_get_sheet_store(), sheet_name)
+    sheet_data = _process_single_sheet(sheet_name, data, _view_columns(sheet_name), previous, columns)
+    if sheet_data is not None:
+        if not _is_reused(previous, sheet_data):
+            save_snapshot(sheet_name, sheet_data)
+        # Se guarda desde el hilo para no perder la carga si la app se re-ejecuta a mitad de camino
+        sheet_data = _store_sheet(sheet_name, sheet_data)
+    return sheet_data, time_lib.perf_counter() - start
+
+def _fetch_and_process_sheet(sh, sheet_name):
+    """Descarga y procesa una sola hoja. Devuelve (datos, segundos)."""
+    start = time_lib.perf_counter()
+    _, data, columns = _fetch_sheets_batch(sh, [sheet_name])[0]
+    return _process_fetched_sheet(sheet_name, data, columns, start)
+
+def _load_claimed_sheet(sheet_name, load, *args):
+    """Corre load(*args) para una hoja reservada con claim_flights y publica el resultado a quien lo espere."""
+    key = _sheet_flight_key(sheet_name)
+    try:
+        result = load(*args)
+    except BaseException as e:
+        resolve_flight(key, error=e)
+        raise
+    resolve_flight(key, result=result)
+    return result
+
+def iter_sheets_parallel(gc: gspread.Client, sheet_names: list):
+    """
+    Genera (nombre_hoja, datos, segundos) a medida que cada hoja está lista.
+    Las hojas que ya están en el almacén salen primero (segundos=None); el
+    resto se descarga con un solo values:batchGet y se procesa en un pool
+    acotado de hilos. Las hojas que otra sesión ya está descargando no se
+    piden de nuevo: se espera su resultado (single-flight).
+    """
+    store = _get_sheet_store()
+    missing = []
+    for sheet_name in sheet_names:
+        cached = store["sheets"].get(sheet_name) or _serve_from_snapshot(gc, sheet_name)
+        if cached is not None:
+            yield sheet_name, cached, None
+        else:
+            missing.append(sheet_name)
+
+    if not missing:
+        return
+
+    try:
+        sh = get_spreadsheet(gc, GOOGLE_SHEET_ID)
+    except Exception as e:
+        st.error(f"Error al abrir la hoja de cálculo: {e}")
+        for sheet_name in missing:
+            yield sheet_name, None, None
+        return
+
+    claimed = claim_flights([_sheet_flight_key(sheet_name) for sheet_name in missing])
+    own = [sheet_name for sheet_name in missing if _sheet_flight_key(sheet_name) in claimed]
+
+    # Los hilos heredan el contexto de ejecución para poder emitir st.warning
+    with ThreadPoolExecutor(
+        max_workers=min(MAX_WORKERS_CARGA, len(missing)),
+        initializer=add_script_run_ctx,
+        initargs=(None, get_script_run_ctx()),
+    ) as pool:
+        # single_flight: si otra sesión ya está descargando la hoja, esperamos su resultado
+        futures = {
+            pool.submit(single_flight, _sheet_flight_key(sheet_name), _fetch_and_process_sheet, sh, sheet_name): sheet_name
+            for sheet_name in missing if sheet_name not in own
+        }
+        pending = list(own)
+        if own:
+            start = time_lib.perf_counter()
+            try:
+                for sheet_name, data, columns in _fetch_sheets_batch(sh, own):
+                    futures[pool.submit(_load_claimed_sheet, sheet_name, _process_fetched_sheet, sheet_name, data, columns, start)] = sheet_name
+                    pending.remove(sheet_name)
+            except Exception as e:
+                # Un rango inválido hace fallar todo el batchGet: las hojas que faltan se piden de a una
+                print(f"Falló la descarga conjunta de {pending}: {e}")
+            except BaseException as e:
+                for sheet_name in pending:
+                    resolve_flight(_sheet_flight_key(sheet_name), error=e)
+                raise
+        for sheet_name in pending:
+            futures[pool.submit(_load_claimed_sheet, sheet_name, _fetch_and_process_sheet, sh, sheet_name)] = sheet_name
+
+        for future in as_completed(futures):
+            sheet_name = futures[future]
+            try:
+                sheet_data, seconds = future.result()
+            except Exception as e:
+                st.error(f"Error al cargar la hoja '{sheet_name}': {e}")
+                sheet_data, seconds = None, None
+            yield sheet_name, sheet_data, seconds
+
+# --- ESCRITURA DIRECTA EN CACHÉ (WRITE-THROUGH) ---
+VERIFICACION_DIFERIDA_SEGUNDOS = 5 # Margen para que Sheets recalcule fórmulas antes de verificar
+
+def _typed_row_frame(sheet_name, columns, row_values):
+    """Convierte una fila tal como se envía a Sheets (strings) en un DataFrame de 1 fila con los tipos de la hoja."""
+    df_row = pl.DataFrame([row_values], schema=list(columns), orient="row")
+    return df_row.with_columns(_build_type_projection(sheet_name, df_row.columns))
+
+def patch_cached_sheet(sheet_name: str, action: str, id_value=None, row_values: list = None):
+    """
+    Aplica a los DataFrames en caché el mismo cambio que se escribió en Sheets:
+    'insert' antepone la fila (se inserta en la fila 2), 'update' reemplaza la
+    fila con ese ID y 'delete' la quita. Devuelve False si la hoja no estaba
+    en caché o no se pudo parchear; en ese caso la entrada queda invalidada.
+    """
+    store = _get_sheet_store()
+    with store["lock"]:
+        cached = store["sheets"].get(sheet_name)
+        if cached is None:
+            return False
+
+        df_full = cached["full"]
+        id_col = df_full.columns[0]
+        if row_values is not None and cached["projected"]:
+            # La fila se escribió completa; en caché solo guardamos las columnas descargadas
+            positions = [cached["columns"].index(c) for c in df_full.columns]
+            row_values = [row_values[i] if i < len(row_values) else "" for i in positions]
+        try:
+            if action == "insert":
+                parts = [_typed_row_frame(sheet_name, df_full.columns, row_values), df_full]
+            else:
+                matches = (
+                    df_full.with_row_index("__fila")
+                    .filter(pl.col(id_col).cast(pl.Utf8) == str(id_value))
+                    .get_column("__fila")
+                )
+                if matches.is_empty():
+                    raise KeyError(id_value)
+                idx = matches[0]
+                parts = [df_full.slice(0, idx)]
+                if action == "update":
+                    parts.append(_typed_row_frame(sheet_name, df_full.columns, row_values))
+                parts.append(df_full.slice(idx + 1))
+            # Si la fila nueva trae un valor fuera del Enum, concat la deja en String; se recategoriza
+            df_full = _apply_categoricals(sheet_name, pl.concat(parts, how="vertical_relaxed"))
+        except Exception:
+            store["sheets"].pop(sheet_name, None)
+            store["versions"][sheet_name] = store["versions"].get(sheet_name, 0) + 1
+            return False
+
+        _put_sheet_entry(store, sheet_name, _make_sheet_entry(df_full, cached["view_columns"], cached["fetched_at"], cached["columns"]))
+        store["versions"][sheet_name] = store["versions"].get(sheet_name, 0) + 1
+    return True
+
+def _refresh_sheets(sh, store, sheet_names, versions):
+    """
+    Descarga 'sheet_names' con un solo values:batchGet y reemplaza la entrada de
+    cada hoja, salvo que su versión ya no sea la de 'versions' (hubo una escritura
+    en el medio). Devuelve {clave single-flight: (entrada, segundos)}, igual que
+    _fetch_and_process_sheet, para las sesiones que esperan esas claves.
+    """
+    start = time_lib.perf_counter()
+    results = {_sheet_flight_key(sheet_name): (None, None) for sheet_name in sheet_names}
+    for sheet_name, data, columns in _fetch_sheets_batch(sh, sheet_names):
+        previous = _previous_entry(store, sheet_name)
+        sheet_data = _process_single_sheet(sheet_name, data, _view_columns(sheet_name), previous, columns)
+        if sheet_data is not None:
+            _swap_sheet_if_current(store, sheet_name, sheet_data, versions[sheet_name])
+            # Si no se reemplazó (hubo una escritura), la entrada vigente es la parcheada
+            sheet_data = store["sheets"].get(sheet_name) or sheet_data
+        results[_sheet_flight_key(sheet_name)] = (sheet_data, time_lib.perf_counter() - start)
+    return results
+
+def _refresh_sheet(gc, store, sheet_name, version):
+    """
+    Re-descarga la hoja en segundo plano y reemplaza la entrada actual
+    (parcheada tras una escritura o servida desde un snapshot).
+    Si mientras tanto hubo otra escritura (cambió la versión), se descarta el resultado.
+    Si la hoja ya se está descargando (una sesión o la precarga), no se repite.
+    Corre en un hilo sin sesión: usa las funciones cacheadas del proceso, pero los
+    st.* que emita el procesamiento no se muestran; los errores van a la consola.
+    """
+    try:
+        with background_priority():
+            sh = get_spreadsheet(gc, GOOGLE_SHEET_ID)
+            single_flight_many(
+                [_sheet_flight_key(sheet_name)],
+                lambda keys: _refresh_sheets(sh, store, [sheet_name], {sheet_name: version}),
+            )
     except Exception as e:
-        st.error(f"Error al cargar la hoja '{sheet_name}': {e}")
+        print(f"Error refrescando la hoja '{sheet_name}': {e}")
+
+def _swap_sheet_if_current(store, sheet_name, sheet_data, version):
+    """
+    Reemplaza la entrada de 'sheet_name' de una sola vez, salvo que la versión
+    haya cambiado desde que se empezó la descarga (hubo una escritura en el medio).
+    """
+    with store["lock"]:
+        if store["versions"].get(sheet_name, 0) != version:
+            return False
+        previous = _put_sheet_entry(store, sheet_name, sheet_data)
+    # Contenido sin cambios: el snapshot en disco ya es este mismo frame
+    if not _is_reused(previous, sheet_data):
+        save_snapshot(sheet_name, sheet_data)
+    return True
+
+def schedule_sheet_refresh(gc: gspread.Client, sheet_name: str, delay: float = 0):
+    """Agenda _refresh_sheet en un hilo daemon, atado a la versión actual de la hoja."""
+    store = _get_sheet_store()
+    version = store["versions"].get(sheet_name, 0)
+    timer = threading.Timer(delay, _refresh_sheet, args=(gc, store, sheet_name, version))
+    timer.daemon = True
+    timer.start()
+
+def sync_cache_after_write(gc: gspread.Client, sheet_name: str, action: str, id_value=None, row_values: list = None):
+    """Parchea la caché tras una escritura y agenda una verificación diferida en vez de recargar bloqueando."""
+    if not patch_cached_sheet(sheet_name, action, id_value=id_value, row_values=row_values):
+        # Sin caché que parchear: la próxima ejecución la descargará completa
+        return
+    schedule_sheet_refresh(gc, sheet_name, delay=VERIFICACION_DIFERIDA_SEGUNDOS)
+
+def _is_cold(store, sheet_name):
+    """True si la hoja nunca se cargó en este proceso (sin entrada, versión ni entrada retirada)."""
+    return (
+        sheet_name not in store["sheets"]
+        and sheet_name not in store["versions"]
+        and sheet_name not in store["retired"]
+    )
+
+def _serve_from_snapshot(gc: gspread.Client, sheet_name: str):
+    """
+    Solo en un arranque en frío: si hay snapshot en disco, lo carga en el almacén,
+    agenda su refresco y lo devuelve. Una hoja invalidada (Recargar, parche
+    fallido) no vuelve al snapshot: se descarga de Google en el momento.
+    """
+    store = _get_sheet_store()
+    if not _is_cold(store, sheet_name):
+        return None
+    entry = load_snapshot(sheet_name)
+    if entry is None:
         return None
+    with store["lock"]:
+        # Otra sesión pudo haberla cargado (o invalidado) mientras leíamos el disco
+        current = store["sheets"].get(sheet_name)
+        if current is None:
+            if not _is_cold(store, sheet_name):
+                return None
+            _put_sheet_entry(store, sheet_name, entry)
+            current = store["sheets"][sheet_name]
+            schedule = True
+        else:
+            schedule = False
+    if schedule:
+        schedule_sheet_refresh(gc, sheet_name)
+    return current
+
+# --- PRECARGA Y REFRESCO PERIÓDICO EN SEGUNDO PLANO ---
+# Un único hilo por proceso descarga todas las hojas de VISTA_COLUMNAS_POR_HOJA,
+# la hoja LISTAS y los rangos del parte diario, y los vuelve a traer cada
+# REFRESCO_FONDO_SEGUNDOS. Así las sesiones leen siempre de memoria y no
+# esperan a Google Sheets. 0 desactiva el refresco (solo se hace la precarga).
+REFRESCO_FONDO_SEGUNDOS = int(os.environ.get("REFRESCO_FONDO_SEGUNDOS", "300"))
+HOJAS_POR_LOTE = 8 # Hojas por cada values:batchGet (acota el tamaño de cada respuesta)
+
+def _fetched_since(store, sheet_name, moment):
+    """True si la entrada vigente de la hoja se descargó de Google después de 'moment'."""
+    entry = store["sheets"].get(sheet_name)
+    return entry is not None and not entry.get("from_snapshot") and entry["fetched_at"] >= moment
+
+def _background_refresh_cycle(gc, store):
+    """
+    Una pasada completa de precarga/refresco, con prioridad de fondo. Corre en un
+    hilo sin sesión: usa las funciones cacheadas del proceso (almacén, plan de
+    esquema), pero los st.* que emita el procesamiento no se muestran.
+    Cada lote reclama sus hojas con las mismas claves single-flight que las
+    sesiones: no se pide una hoja que ya se está descargando ni una que se
+    descargó después de empezar la pasada.
+    """
+    cycle_start = datetime.now()
+    with background_priority():
+        sh = get_spreadsheet(gc, GOOGLE_SHEET_ID)
+        titles = get_worksheets(sh)
+        sheet_names = [name for name in VISTA_COLUMNAS_POR_HOJA if name in titles]
+
+        for start in range(0, len(sheet_names), HOJAS_POR_LOTE):
+            batch = [name for name in sheet_names[start:start + HOJAS_POR_LOTE] if not _fetched_since(store, name, cycle_start)]
+            if not batch:
+                continue
+            # Versiones al momento de pedir: si hay una escritura mientras tanto, no pisamos su parche
+            versions = {name: store["versions"].get(name, 0) for name in batch}
+            names_by_key = {_sheet_flight_key(name): name for name in batch}
+            try:
+                single_flight_many(
+                    list(names_by_key),
+                    lambda keys: _refresh_sheets(sh, store, [names_by_key[key] for key in keys], versions),
+                )
+            except Exception as e:
+                print(f"Error refrescando las hojas {', '.join(batch)}: {e}")
+
+        try:
+            sync_search_index()
+            sync_cred_index()
+        except Exception as e:
+            print(f"Error actualizando los índices de búsqueda: {e}")
+
+        try:
+            load_listas_snapshot(gc, force=True)
+        except Exception as e:
+            print(f"Error refrescando la hoja '{LISTAS_SHEET_NAME}': {e}")
+
+        try:
+            prefetch_ranges(sh, HOJA_PARTE_DIARIO, RANGOS_PARTE_DIARIO.values())
+        except Exception as e:
+            print(f"Error refrescando los rangos de '{HOJA_PARTE_DIARIO}': {e}")
+
+def _background_refresh_loop(gc, store):
+    while True:
+        try:
+            _background_refresh_cycle(gc, store)
+        except Exception as e:
+            print(f"Error en el refresco de fondo: {e}")
+        if REFRESCO_FONDO_SEGUNDOS <= 0:
+            return
+        time_lib.sleep(REFRESCO_FONDO_SEGUNDOS)
+
+@st.cache_resource
+def start_background_refresher(_gc: gspread.Client):
+    """Arranca (una sola vez por proceso) el hilo daemon de precarga y refresco."""
+    thread = threading.Thread(
+        target=_background_refresh_loop,
+        args=(_gc, _get_sheet_store()),
+        name="sheets-refresher",
+        daemon=True,
+    )
+    thread.start()
+    return thread
+
+# --- EXPORTACIÓN (EXCEL, CSV Y PARQUET) ---
+# Cada archivo se genera recién cuando alguien lo pide ("Preparar") y queda en
+# una caché LRU por (hoja, versión de datos, filtro, formato): los reruns
+# comunes no escriben ningún archivo. CSV y Parquet salen directo del frame
+# filtrado y son mucho más rápidos y livianos que el .xlsx.
+EXPORTES_EN_CACHE = 12 # Archivos generados que se conservan en memoria
+FILAS_POR_TANDA_EXCEL = 5000
+
+def _excel_cell_writers(worksheet, df, date_format):
+    """Una función de escritura por columna según su tipo (las fechas quedan como fechas de Excel)."""
+    writers = []
+    for dtype in df.dtypes:
+        if dtype == pl.Date:
+            writers.append(lambda row, col, value: worksheet.write_datetime(row, col, value, date_format))
+        elif dtype.is_numeric():
+            writers.append(worksheet.write_number)
+        else:
+            writers.append(lambda row, col, value: worksheet.write_string(row, col, str(value)))
+    return writers
 
 def to_excel(df: pl.DataFrame):
-    """Convierte un DataFrame de Polars a un archivo Excel en memoria."""
+    """
+    Convierte un DataFrame de Polars a un archivo Excel en memoria. Se escribe
+    fila por fila con xlsxwriter en modo constant_memory: cada fila se vuelca
+    al archivo apenas se completa, así una hoja grande no se arma entera en RAM.
+    """
     output = io.BytesIO()
     try:
-        df.write_excel(output)
+        with xlsxwriter.Workbook(output, {"constant_memory": True}) as workbook:
+            worksheet = workbook.add_worksheet()
+            header_format = workbook.add_format({"bold": True})
+            date_format = workbook.add_format({"num_format": "dd/mm/yyyy"})
+            worksheet.write_row(0, 0, df.columns, header_format)
+            writers = _excel_cell_writers(worksheet, df, date_format)
+            row_number = 1
+            for chunk in df.iter_slices(FILAS_POR_TANDA_EXCEL):
+                for row in chunk.iter_rows():
+                    for col, value in enumerate(row):
+                        if value is not None:
+                            writers[col](row_number, col, value)
+                    row_number += 1
     except Exception as e:
         # Fallback por si acaso
         print(f"Error escribiendo excel: {e}")
         return None
     return output.getvalue()
 
+def to_csv(df: pl.DataFrame):
+    """CSV en memoria (UTF-8 con BOM, para que Excel respete los acentos), escrito por Polars de una vez."""
+    output = io.BytesIO()
+    try:
+        df.write_csv(output, include_bom=True, date_format="%d/%m/%Y")
+    except Exception as e:
+        print(f"Error escribiendo csv: {e}")
+        return None
+    return output.getvalue()
+
+def to_parquet(df: pl.DataFrame):
+    """Parquet del frame tal cual (conserva tipos, incluidos Enum/Categorical)."""
+    output = io.BytesIO()
+    try:
+        df.write_parquet(output)
+    except Exception as e:
+        print(f"Error escribiendo parquet: {e}")
+        return None
+    return output.getvalue()
+
+# formato: (nombre, función, tipo MIME)
+FORMATOS_EXPORTACION = {
+    "xlsx": ("Excel", to_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv": ("CSV", to_csv, "text/csv"),
+    "parquet": ("Parquet", to_parquet, "application/vnd.apache.parquet"),
+}
+
+@st.cache_data(max_entries=EXPORTES_EN_CACHE, show_spinner=False)
+def _cached_export(sheet_name: str, data_version: int, filter_key: tuple, file_format: str, _df: pl.DataFrame):
+    """Archivo del resultado filtrado. La clave es (hoja, versión, filtro, formato); _df no se hashea."""
+    return FORMATOS_EXPORTACION[file_format][1](_df)
+
+def export_on_demand(sheet_name, export_key, file_format, df):
+    """
+    "Preparar <formato>" y, una vez pedido, el botón de descarga del resultado
+    filtrado. El pedido vale mientras no cambien los datos ni el filtro (export_key).
+    """
+    label, _, mime = FORMATOS_EXPORTACION[file_format]
+    requested_key = f"export_requested_{file_format}_{sheet_name}"
+    if st.session_state.get(requested_key) != export_key:
+        if not st.button(f"📥 Preparar {label}", key=f"btn_prepare_{file_format}_{sheet_name}"):
+            return
+        st.session_state[requested_key] = export_key
+
+    with st.spinner(f"Generando {label}..."):
+        data = _cached_export(sheet_name, *export_key, file_format, df)
+    if data is None:
+        st.error(f"No se pudo generar el archivo {label}.")
+        return
+    st.download_button(
+        label=f"📥 Descargar {label}",
+        data=data,
+        file_name=f"{sheet_name}_{datetime.now().strftime('%Y-%m-%d')}.{file_format}",
+        mime=mime,
+        on_click="ignore",
+        key=f"btn_{file_format}_{sheet_name}"
+    )
+
+# --- FRAGMENTO POR HOJA ---
+# Cada hoja se dibuja dentro de un st.fragment: un clic en la tabla, una tecla
+# en "Buscar:" o un cambio de modo solo re-ejecutan esa hoja. Las escrituras y
+# la recarga siguen haciendo st.rerun() de toda la app, porque cambian datos
+# que se ven en el resto de la página (búsqueda global, legajo).
+# Un fragmento no puede llamar a st.sidebar: main() reserva un st.empty() por
+# hoja en el sidebar y se lo pasa al fragmento, que reescribe ahí los conteos
+# en cada rerun propio (sin forzar un rerun de toda la app). Los conteos quedan
+# en session_state para seguir mostrándolos mientras la hoja está en un formulario.
+@st.fragment
+def sheet_fragment(gc: gspread.Client, sheet_name: str, sheet_data_dict: dict, load_seconds: float = None, counts_slot=None):
+    """Dibuja la hoja como una unidad que se re-ejecuta sola."""
+    # En un rerun del fragmento se repiten los argumentos del último run completo:
+    # usamos la entrada vigente del almacén por si el refresco de fondo la reemplazó.
+    current = _get_sheet_store()["sheets"].get(sheet_name)
+    if current is not None and current is not sheet_data_dict:
+        sheet_data_dict, load_seconds = current, None
+    render_sheet(gc, sheet_name, sheet_data_dict, load_seconds)
+    if counts_slot is not None:
+        render_sheet_counts(counts_slot, sheet_name)
+
+def _publish_sheet_counts(sheet_name, counts):
+    """Guarda (filtradas, total) de la hoja para el sidebar."""
+    st.session_state[f"rows_{sheet_name}"] = counts
+
+def render_sheet_counts(counts_slot, sheet_name):
+    """Estadísticas de la hoja en su lugar reservado del sidebar (reemplaza las anteriores)."""
+    counts = st.session_state.get(f"rows_{sheet_name}")
+    if counts is None:
+        counts_slot.empty()
+        return
+    with counts_slot.container():
+        st.markdown(f"**{sheet_name}**")
+        st.caption(f"Filas: {counts[0]} / {counts[1]}")
+        st.divider()
+
+# --- RENDERIZADO DE UNA HOJA ---
+FILAS_POR_PAGINA = 500 # Filas por página de la tabla
+
+def render_sheet(gc: gspread.Client, sheet_name: str, sheet_data_dict: dict, load_seconds: float = None):
+    """Dibuja la hoja (tabla, filtros, formularios y acciones) en el contenedor actual."""
+    if not sheet_data_dict:
+        st.error(f"No se pudieron cargar los datos de {sheet_name}")
+        return
+
+    # Inicializar estado para esta hoja específica
+    init_sheet_state(sheet_name)
+    current_mode = get_sheet_mode(sheet_name)
+    
+    # Contenedor visual para separar las hojas
+    with st.container():
+        # Encabezado con color distintivo o separador
+        st.markdown(f"## 📂 Hoja: `{sheet_name}`")
+        if load_seconds is not None:
+            st.caption(f"⏱️ Cargada desde Google Sheets en {load_seconds:.2f} s")
+        elif sheet_data_dict.get("from_snapshot"):
+            st.caption(f"💾 Datos guardados el {sheet_data_dict['fetched_at']:%d/%m/%Y %H:%M}. Actualizando en segundo plano...")
+        
+        df_full = sheet_data_dict["full"]
+        view_columns = sheet_data_dict["view_columns"]
+        all_columns = sheet_data_dict["columns"] # Todos los encabezados (aunque 'full' venga proyectado)
+        
+        # --- LÓGICA DE MODOS POR HOJA ---
+        if current_mode == "add":
+            show_add_form(gc, sheet_name, all_columns, sync_cache_after_write)
+        
+        elif current_mode == "edit":
+            row_data = get_sheet_edit_data(sheet_name)
+            if row_data:
+                show_edit_form(gc, row_data, sheet_name, all_columns, sync_cache_after_write)
+            else:
+                st.error("Error de estado: No hay datos para editar.")
+                set_sheet_mode(sheet_name, "view")
+                rerun_sheet()
+        
+        else: # MODO VISTA (Tabla y Filtros)
+            
+            # Botonera de la hoja
+            col_actions, col_reload = st.columns([0.8, 0.2])
+            with col_actions:
+                if st.button(f"➕ Nuevo Registro en {sheet_name}", key=f"btn_add_{sheet_name}"):
+                    set_sheet_mode(sheet_name, "add")
+                    rerun_sheet()
+            with col_reload:
+                if st.button("🔄 Recargar", key=f"btn_reload_{sheet_name}"):
+                    invalidate_sheet(sheet_name)
+                    st.rerun()
+
+            # Filtros (Namespace único por hoja). Se arman sobre la vista perezosa
+            # y se materializa una sola vez el resultado, sin copiar la hoja completa.
+            lf_filtered = sheet_view(sheet_data_dict)
+            schema = df_full.schema
+            with st.expander(f"🔍 Filtros para {sheet_name}", expanded=False):
+                # Permitimos filtrar por columnas de Texto, Numéricas y FECHAS
+                filterable_cols = [c for c in view_columns if schema[c] in [pl.String, pl.Int64, pl.Float64, pl.Date] or _is_categorical(schema[c])]
+                
+                sel_cols = st.multiselect("Columnas:", filterable_cols, default=filterable_cols[:6] if len(filterable_cols)>1 else filterable_cols, key=f"cols_{sheet_name}")
+                cond = st.selectbox("Condición:", ["Contiene texto", "Celda Vacía", "Celda No Vacía"], key=f"cond_{sheet_name}")
+                
+                term = ""
+                if cond == "Contiene texto":
+                    term = st.text_input("Buscar:", key=f"term_{sheet_name}")
+
+                if sel_cols:
+                    if cond == "Celda Vacía":
+                        expr = [(pl.col(c).is_null()) | (pl.col(c).cast(pl.Utf8) == "") for c in sel_cols]
+                        lf_filtered = lf_filtered.filter(pl.any_horizontal(expr))
+                    elif cond == "Celda No Vacía":
+                        expr = [(pl.col(c).is_not_null()) & (pl.col(c).cast(pl.Utf8) != "") for c in sel_cols]
+                        lf_filtered = lf_filtered.filter(pl.any_horizontal(expr))
+                    elif term:
+                        # Contains literal sobre la clave precalculada (minúsculas, sin acentos)
+                        lf_filtered = lf_filtered.filter(search_mask(sheet_data_dict, sel_cols, term))
+
+            df_filtered = lf_filtered.collect()
+
+            # Estadísticas para el sidebar (las dibuja sheet_fragment)
+            _publish_sheet_counts(sheet_name, (df_filtered.height, df_full.height))
+
+            # Tabla paginada: se corta la página en el servidor y al navegador solo
+            # viaja esa porción, por grande que sea la hoja
+            filter_key = (tuple(sel_cols), cond, term)
+            total_pages = max(1, -(-df_filtered.height // FILAS_POR_PAGINA))
+            page_key = f"page_{sheet_name}"
+            if st.session_state.get(f"page_filter_{sheet_name}") != filter_key:
+                # Filtro nuevo: volvemos a la primera página
+                st.session_state[f"page_filter_{sheet_name}"] = filter_key
+                st.session_state[page_key] = 1
+            elif st.session_state.get(page_key, 1) > total_pages:
+                st.session_state[page_key] = total_pages
+
+            page = 1
+            if total_pages > 1:
+                col_page, _ = st.columns([0.2, 0.8])
+                with col_page:
+                    page = st.number_input(f"Página (de {total_pages}):", min_value=1, max_value=total_pages, step=1, key=page_key)
+            offset = (page - 1) * FILAS_POR_PAGINA
+            df_page = df_filtered.slice(offset, FILAS_POR_PAGINA)
+
+            if total_pages > 1:
+                st.write(f"Mostrando filas **{offset + 1}–{offset + df_page.height}** de **{df_filtered.height}** ({df_full.height} en la hoja).")
+            else:
+                st.write(f"Mostrando **{df_filtered.height}** de {df_full.height} filas.")
+            
+            # Configuración de columnas para formato de fecha
+            column_config = {}
+            for col_name in df_filtered.columns:
+                if df_filtered[col_name].dtype == pl.Date:
+                    column_config[col_name] = st.column_config.DateColumn(
+                        col_name,
+                        format="DD/MM/YYYY",
+                        step=1
+                    )
+
+            # La key incluye la página: la selección no se arrastra a otra página
+            selection = st.dataframe(
+                df_page,
+                column_config=column_config,
+                selection_mode="single-row",
+                on_select="rerun",
+                hide_index=True,
+                width='stretch',
+                key=f"grid_{sheet_name}_{page}"
+            )
+
+            # Descargas bajo demanda: cada archivo se genera al pedirlo y se reutiliza
+            # mientras no cambien los datos (data_version) ni el filtro
+            export_key = (sheet_data_dict["data_version"], filter_key)
+            for column, file_format in zip(st.columns(len(FORMATOS_EXPORTACION)), FORMATOS_EXPORTACION):
+                with column:
+                    export_on_demand(sheet_name, export_key, file_format, df_filtered)
+
+            # Acción de Selección
+            if selection.selection["rows"]:
+                try:
+                    sel_idx = selection.selection["rows"][0]
+                    # ... resto del código ...
+                    # El índice es relativo a la página; el ID lleva a la fila de df_full
+                    sel_row_view = df_page.row(sel_idx, named=True)
+                    id_val = sel_row_view[view_columns[0]] # ID usando primera columna vista
+                    
+                    # Fila completa (en carga proyectada se pide a Sheets recién ahora)
+                    full_row_dict = load_full_row(gc, sheet_name, sheet_data_dict, id_val)
+                    
+                    if full_row_dict is not None:
+                        
+                        st.info(f"Fila seleccionada: {id_val}")
+                        
+                        # Botonera de acciones sobre la fila
+                        col_edit, col_delete = st.columns([0.3, 0.3])
+                        with col_edit:
+                            if st.button(f"✏️ Editar", key=f"btn_edit_sel_{sheet_name}_{id_val}"):
+                                set_sheet_mode(sheet_name, "edit", full_row_dict)
+                                rerun_sheet()
+                        
+                        with col_delete:
+                            if st.button(f"🗑️ Eliminar", key=f"btn_delete_sel_{sheet_name}_{id_val}", type="primary"):
+                                try:
+                                    with st.spinner("Eliminando registro..."):
+                                        worksheet = get_worksheet(get_spreadsheet(gc, GOOGLE_SHEET_ID), sheet_name)
+                                        row_number = locate_sheet_row(worksheet, sheet_name, id_val)
+                                        if row_number:
+                                            worksheet.delete_rows(row_number)
+                                            st.success("✅ Fila eliminada correctamente.")
+                                            sync_cache_after_write(gc, sheet_name, "delete", id_value=id_val)
+                                            st.rerun()
+                                        else:
+                                            st.error("❌ No se encontró la fila en Google Sheets.")
+                                except Exception as e:
+                                    st.error(f"❌ Error al eliminar: {e}")
+
+                        # Copiado Manual
+                        if sheet_name in BOTONES_COPIADO_POR_HOJA:
+                            st.caption("Datos para copiar:")
+                            b_cols = st.columns(3)
+                            idx = 0
+                            for lbl, c_name in BOTONES_COPIADO_POR_HOJA[sheet_name].items():
+                                val = str(full_row_dict.get(c_name, ""))
+                                # Key única incluyendo ID y Sheet para refresco correcto
+                                b_cols[idx].text_input(lbl, value=val, key=f"copy_{sheet_name}_{c_name}_{id_val}")
+                                idx = (idx + 1) % 3
+
+                except Exception as e:
+                    st.error(f"Error al seleccionar: {e}")
+
+    st.divider() # Separador visual entre hojas
+
+# --- BÚSQUEDA GLOBAL ---
+RESULTADOS_POR_HOJA = 50 # Filas que se muestran por hoja en la búsqueda global
+
+def render_global_search():
+    """Buscador sobre todas las hojas cargadas (índice global), con las coincidencias agrupadas por hoja."""
+    with st.expander("🔎 Buscar en todas las hojas (CRED., D.N.I., nombre...)"):
+        term = st.text_input("Buscar:", key="global_search", placeholder="Ej: 12345, 30.123.456 o perez juan")
+        if not term:
+            index = _get_search_index()
+            st.caption(f"Hojas indexadas: {len(index['seq'])} / {len(VISTA_COLUMNAS_POR_HOJA)}")
+            return
+
+        start = time_lib.perf_counter()
+        hits = search_all_sheets(term)
+        elapsed_ms = (time_lib.perf_counter() - start) * 1000
+        total = sum(len(ids) for ids in hits.values())
+        st.caption(f"{total} coincidencias en {len(hits)} hojas ({elapsed_ms:.0f} ms)")
+
+        store = _get_sheet_store()["sheets"]
+        for sheet_name in [name for name in VISTA_COLUMNAS_POR_HOJA if name in hits]:
+            sheet_data = store.get(sheet_name)
+            if sheet_data is None:
+                continue
+            ids = hits[sheet_name]
+            positions = [sheet_data["row_index"][id_value] - 2 for id_value in ids[:RESULTADOS_POR_HOJA] if id_value in sheet_data["row_index"]]
+            st.markdown(f"**{sheet_name}** — {len(ids)}")
+            st.dataframe(sheet_data["full"][positions].select(sheet_data["view_columns"]), hide_index=True, width='stretch')
+
+# --- LEGAJO POR CREDENCIAL ---
+def render_person_timeline():
+    """Línea de tiempo de una persona (todas las hojas cargadas) a partir de su credencial."""
+    with st.expander("🗂️ Legajo por credencial"):
+        cred = st.text_input("CRED.:", key="dossier_cred", placeholder="Ej: 12345").strip()
+        if not cred:
+            return
+
+        start = time_lib.perf_counter()
+        timeline = build_person_timeline(cred)
+        elapsed_ms = (time_lib.perf_counter() - start) * 1000
+        if timeline.is_empty():
+            st.info(f"No hay registros con la credencial {cred} en las hojas cargadas.")
+            return
+
+        dotacion = _get_sheet_store()["sheets"].get("DOTACION")
+        if dotacion is not None and "CRED." in dotacion["full"].columns:
+            person = dotacion["full"].filter(
+                pl.col("CRED.").cast(pl.Utf8).str.replace_all(r"\D", "") == normalize_credential(cred)
+            )
+            if person.height:
+                row = person.row(0, named=True)
+                st.markdown(f"**{row.get('GRADO') or ''} {row.get('APELLIDOS') or ''} {row.get('NOMBRES') or ''}**")
+
+        counts = timeline.group_by("HOJA", maintain_order=True).len()
+        st.caption(" · ".join(f"{hoja}: {n}" for hoja, n in counts.iter_rows()) + f" ({elapsed_ms:.0f} ms)")
+        st.dataframe(
+            timeline,
+            hide_index=True,
+            width='stretch',
+            column_config={"FECHA": st.column_config.DateColumn("FECHA", format="DD/MM/YYYY")},
+        )
+
 # --- MAIN APP ---
 def main():
     st.title("SECCION PERSONAL - CPF III")
@@ -478,6 +1984,9 @@ def main():
     gc = get_gspread_client()
     if not gc: st.stop()
 
+    # Precarga y refresco de fondo (no bloquea: solo arranca el hilo la primera vez)
+    start_background_refresher(gc)
+
     # 1. Obtener lista de hojas (rápido)
     sheet_names = get_available_sheets(gc)
     if not sheet_names:
@@ -504,180 +2013,35 @@ def main():
             max_selections=6,
             key="multi_sheet_selector"
         )
+    render_global_search()
+    render_person_timeline()
     st.markdown("---")
 
     if not selected_sheets:
         st.info("👆 Por favor, selecciona al menos una hoja arriba.")
         return
 
-    # 3. Cargar y mostrar SOLO las hojas seleccionadas
-    for sheet_name in selected_sheets:
-        
-        # Carga bajo demanda
-        sheet_data_dict = load_sheet_data(gc, sheet_name)
-        
-        if not sheet_data_dict:
-            st.error(f"No se pudieron cargar los datos de {sheet_name}")
-            continue
+    # 3. Cargar SOLO las hojas seleccionadas, en paralelo.
+    # Reservamos un contenedor por hoja para respetar el orden elegido
+    # y dibujamos cada una apenas termina su carga.
+    containers = {sheet_name: st.container() for sheet_name in selected_sheets}
+    counts_slots = {sheet_name: st.sidebar.empty() for sheet_name in selected_sheets}
 
-        # Inicializar estado para esta hoja específica
-        init_sheet_state(sheet_name)
-        current_mode = get_sheet_mode(sheet_name)
-        
-        # Contenedor visual para separar las hojas
-        with st.container():
-            # Encabezado con color distintivo o separador
-            st.markdown(f"## 📂 Hoja: `{sheet_name}`")
-            
-            df_full = sheet_data_dict["full"]
-            df_view = sheet_data_dict["view"]
-            all_columns = df_full.columns # Polars columns list
-            
-            # --- LÓGICA DE MODOS POR HOJA ---
-            if current_mode == "add":
-                show_add_form(gc, sheet_name, all_columns, load_sheet_data.clear)
-            
-            elif current_mode == "edit":
-                row_data = get_sheet_edit_data(sheet_name)
-                if row_data:
-                    show_edit_form(gc, row_data, sheet_name, all_columns, load_sheet_data.clear)
-                else:
-                    st.error("Error de estado: No hay datos para editar.")
-                    set_sheet_mode(sheet_name, "view")
-                    st.rerun()
-            
-            else: # MODO VISTA (Tabla y Filtros)
-                
-                # Botonera de la hoja
-                col_actions, col_reload = st.columns([0.8, 0.2])
-                with col_actions:
-                    if st.button(f"➕ Nuevo Registro en {sheet_name}", key=f"btn_add_{sheet_name}"):
-                        set_sheet_mode(sheet_name, "add")
-                        st.rerun()
-                with col_reload:
-                    if st.button("🔄 Recargar", key=f"btn_reload_{sheet_name}"):
-                        load_sheet_data.clear()
-                        st.rerun()
-
-                # Filtros (Namespace único por hoja)
-                df_filtered = df_view.clone()
-                with st.expander(f"🔍 Filtros para {sheet_name}", expanded=False):
-                    # Permitimos filtrar por columnas de Texto, Numéricas y FECHAS
-                    filterable_cols = [c for c in df_filtered.columns if df_filtered[c].dtype in [pl.String, pl.Int64, pl.Float64, pl.Date]]
-                    
-                    sel_cols = st.multiselect("Columnas:", filterable_cols, default=filterable_cols[:6] if len(filterable_cols)>1 else filterable_cols, key=f"cols_{sheet_name}")
-                    cond = st.selectbox("Condición:", ["Contiene texto", "Celda Vacía", "Celda No Vacía"], key=f"cond_{sheet_name}")
-                    
-                    term = ""
-                    if cond == "Contiene texto":
-                        term = st.text_input("Buscar:", key=f"term_{sheet_name}")
-
-                    if sel_cols:
-                        if cond == "Celda Vacía":
-                            expr = [(pl.col(c).is_null()) | (pl.col(c).cast(pl.Utf8) == "") for c in sel_cols]
-                            df_filtered = df_filtered.filter(pl.any_horizontal(expr))
-                        elif cond == "Celda No Vacía":
-                            expr = [(pl.col(c).is_not_null()) & (pl.col(c).cast(pl.Utf8) != "") for c in sel_cols]
-                            df_filtered = df_filtered.filter(pl.any_horizontal(expr))
-                        elif term:
-                            # Casteamos todo a string para buscar texto
-                            expr = [pl.col(c).cast(pl.Utf8).fill_null("").str.contains(f"(?i){re.escape(term)}") for c in sel_cols]
-                            df_filtered = df_filtered.filter(pl.any_horizontal(expr))
-
-                # Estadísticas en Sidebar (Acumulativas)
-                with st.sidebar:
-                    st.markdown(f"**{sheet_name}**")
-                    st.caption(f"Filas: {df_filtered.height} / {df_full.height}")
-                    st.divider()
-
-                # Tabla
-                st.write(f"Mostrando **{df_filtered.height}** filas.")
-                
-                # Configuración de columnas para formato de fecha
-                column_config = {}
-                for col_name in df_filtered.columns:
-                    if df_filtered[col_name].dtype == pl.Date:
-                        column_config[col_name] = st.column_config.DateColumn(
-                            col_name,
-                            format="DD/MM/YYYY",
-                            step=1
-                        )
-
-                selection = st.dataframe(
-                    df_filtered,
-                    column_config=column_config,
-                    selection_mode="single-row",
-                    on_select="rerun",
-                    hide_index=True,
-                    width='stretch',
-                    key=f"grid_{sheet_name}"
-                )
-
-                # Botón de Descarga Excel
-                st.download_button(
-                    label="📥 Descargar Excel",
-                    data=to_excel(df_filtered),
-                    file_name=f"{sheet_name}_{datetime.now().strftime('%Y-%m-%d')}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    key=f"btn_xlsx_{sheet_name}"
-                )
-
-                # Acción de Selección
-                if selection.selection["rows"]:
-                    try:
-                        sel_idx = selection.selection["rows"][0]
-                        # ... resto del código ...
-                        sel_row_view = df_filtered.row(sel_idx, named=True)
-                        id_val = sel_row_view[df_view.columns[0]] # ID usando primera columna vista
-                        
-                        # Buscar en full
-                        # Convertir a string para asegurar match
-                        full_row = df_full.filter(pl.col(df_view.columns[0]).cast(pl.Utf8) == str(id_val))
-                        
-                        if not full_row.is_empty():
-                            full_row_dict = full_row.row(0, named=True)
-                            
-                            st.info(f"Fila seleccionada: {id_val}")
-                            
-                            # Botonera de acciones sobre la fila
-                            col_edit, col_delete = st.columns([0.3, 0.3])
-                            with col_edit:
-                                if st.button(f"✏️ Editar", key=f"btn_edit_sel_{sheet_name}_{id_val}"):
-                                    set_sheet_mode(sheet_name, "edit", full_row_dict)
-                                    st.rerun()
-                            
-                            with col_delete:
-                                if st.button(f"🗑️ Eliminar", key=f"btn_delete_sel_{sheet_name}_{id_val}", type="primary"):
-                                    try:
-                                        with st.spinner("Eliminando registro..."):
-                                            sh = gc.open_by_key(GOOGLE_SHEET_ID)
-                                            worksheet = sh.worksheet(sheet_name)
-                                            cell = worksheet.find(str(id_val), in_column=1)
-                                            if cell:
-                                                worksheet.delete_rows(cell.row)
-                                                st.success("✅ Fila eliminada correctamente.")
-                                                load_sheet_data.clear()
-                                                st.rerun()
-                                            else:
-                                                st.error("❌ No se encontró la fila en Google Sheets.")
-                                    except Exception as e:
-                                        st.error(f"❌ Error al eliminar: {e}")
-
-                            # Copiado Manual
-                            if sheet_name in BOTONES_COPIADO_POR_HOJA:
-                                st.caption("Datos para copiar:")
-                                b_cols = st.columns(3)
-                                idx = 0
-                                for lbl, c_name in BOTONES_COPIADO_POR_HOJA[sheet_name].items():
-                                    val = str(full_row_dict.get(c_name, ""))
-                                    # Key única incluyendo ID y Sheet para refresco correcto
-                                    b_cols[idx].text_input(lbl, value=val, key=f"copy_{sheet_name}_{c_name}_{id_val}")
-                                    idx = (idx + 1) % 3
-
-                    except Exception as e:
-                        st.error(f"Error al seleccionar: {e}")
-
-        st.divider() # Separador visual entre hojas
+    st.session_state["full_run_in_progress"] = True
+    try:
+        for sheet_name, sheet_data_dict, load_seconds in iter_sheets_parallel(gc, selected_sheets):
+            with containers[sheet_name]:
+                sheet_fragment(gc, sheet_name, sheet_data_dict, load_seconds, counts_slots[sheet_name])
+    finally:
+        st.session_state["full_run_in_progress"] = False
+
+    # 4. Uso de la cuota compartida de la API (todas las sesiones del proceso)
+    quota = get_quota_stats()
+    with st.sidebar:
+        st.caption(f"📶 Cuota Sheets (último minuto): {quota['ultimo_minuto']} / {quota['limite_por_minuto']}")
+        st.progress(min(quota["uso_cuota"], 1.0))
+        if quota["reintentos"]:
+            st.caption(f"Reintentos: {quota['reintentos']} (429: {quota['errores_429']}, 5xx: {quota['errores_5xx']})")
 
 if __name__ == "__main__":
     main()
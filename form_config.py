@@ -1,30 +1,97 @@
 import streamlit as st
+import polars as pl
 import gspread
+import gspread.utils
+import json
 import re
+import time
 from datetime import datetime
+from sheets_api import single_flight, get_spreadsheet
 
 # --- CONFIGURACIÓN CENTRALIZADA ---
 # ID de tu Google Sheet (movido aquí para evitar importaciones circulares)
 GOOGLE_SHEET_ID = "1UOA2HHY1b2W56Ei4YG32sYVJ-0P0zzJcx1C7bBYVK1Q"
 
+# --- RANGOS DEL PARTE DIARIO ---
+# Tablas dinámicas que muestra pages/PARTE_DIARIO.py. Están acá para que el
+# refresco de fondo de app.py pueda precargarlas sin importar la página.
+HOJA_PARTE_DIARIO = "Tabla dinámica 1"
+RANGOS_PARTE_DIARIO = {
+    "RECUENTO": "A2:E5",
+    "OFICIALES": "A7:E22",
+    "SUBOFICIALES": "A25:E32",
+    "PENDIENTE_DE_PRESENTACION": "G2:L",
+    "PENDIENTE_DE_NOTIFICACION": "M2:R",
+    "RECUENTO_DE_INASISTENCIAS": "T2:V",
+    "PARTE_DE_ENFERMO": "Y2:AF",
+    "PARTE_DE_ASISTENCIA_FAMILIAR": "AJ2:AP",
+    "ACCIDENTE_DE_SERVICIO": "AS2:AZ",
+    "CAPACIDAD_LABORAL": "BC2:BJ",
+    "DISPONIBILIDAD": "BN2:BU",
+    "RENUNCIA": "BZ2:CF",
+    "FALLECIMIENTO": "CK2:CQ",
+    "SUSPENSION_PREVENTIVA": "CV2:DA",
+    "INASISTENCIA_INJUSTIFICADA": "DG2:DL",
+}
+
 # --- CARGA DE LISTAS DESPLEGABLES ---
-@st.cache_data(ttl=600)
+# La hoja "LISTAS" se lee completa en una sola llamada y se guarda en memoria
+# indexada por columna. Todos los rangos de FORM_CONFIG (K1:K17, N1:N19, ...)
+# se responden desde esa foto, que se refresca entera cada LISTAS_TTL_SEGUNDOS.
+LISTAS_SHEET_NAME = "LISTAS"
+LISTAS_TTL_SEGUNDOS = 600
+
+# (columnas, momento_de_carga). Se reemplaza la tupla completa: nunca se ve una foto a medio armar.
+_listas_snapshot = None
+
+def _fetch_listas_columns(conn: gspread.Client):
+    """Descarga la hoja LISTAS y la transpone a una lista de columnas."""
+    sh = get_spreadsheet(conn, GOOGLE_SHEET_ID)
+    response = sh.values_get(gspread.utils.absolute_range_name(LISTAS_SHEET_NAME))
+    rows = gspread.utils.fill_gaps(response.get("values", []))
+    return [list(column) for column in zip(*rows)]
+
+def load_listas_snapshot(conn: gspread.Client, force: bool = False):
+    """
+    Devuelve la hoja LISTAS como lista de columnas (columna A = índice 0).
+    Solo llama a la API si la foto no existe, venció o se pide 'force'.
+    """
+    global _listas_snapshot
+    snapshot = _listas_snapshot
+    if not force and snapshot is not None and time.monotonic() - snapshot[1] < LISTAS_TTL_SEGUNDOS:
+        return snapshot[0]
+
+    columns = single_flight(("listas", GOOGLE_SHEET_ID), _fetch_listas_columns, conn)
+    _listas_snapshot = (columns, time.monotonic())
+    return columns
+
+def listas_options(range_name: str):
+    """
+    Fuente de opciones dinámica para FORM_CONFIG: devuelve una función (conn) -> opciones
+    que lee 'range_name' de LISTAS. Guarda el rango en '.range_name' para el plan de esquema.
+    """
+    def load(conn: gspread.Client):
+        return get_options_from_sheet(conn, range_name)
+    load.range_name = range_name
+    return load
+
 def get_options_from_sheet(_conn: gspread.Client, range_name: str):
     """
     Busca una lista de opciones en la hoja 'LISTAS'.
-    El argumento '_conn' tiene un guion bajo para que st.cache_data lo ignore.
+    Se resuelve desde la foto en memoria de LISTAS (ver load_listas_snapshot).
     """
     try:
-        # Abre la hoja "LISTAS" usando el ID
-        sh = _conn.open_by_key(GOOGLE_SHEET_ID)
-        sheet = sh.worksheet("LISTAS")
-        
-        # .get() devuelve una lista de listas, ej: [['GRADO 1'], ['GRADO 2']]
-        values = sheet.get(range_name)
-        
-        # Convertimos a una lista simple: ['GRADO 1', 'GRADO 2']
+        columns = load_listas_snapshot(_conn)
+
+        # Traducimos el rango A1 a índices (0-based, fin exclusivo). Igual que antes,
+        # solo se usa la primera columna del rango.
+        grid = gspread.utils.a1_range_to_grid_range(range_name)
+        col_idx = grid.get("startColumnIndex", 0)
+        column = columns[col_idx] if col_idx < len(columns) else []
+        values = column[grid.get("startRowIndex", 0):grid.get("endRowIndex", len(column))]
+
         # Nos aseguramos de filtrar valores vacíos
-        options = [item[0] for item in values if item and item[0]]
+        options = [item for item in values if item]
         
         if not options:
             st.warning(f"La lista {range_name} se cargó vacía desde Google Sheets.")
@@ -32,8 +99,12 @@ def get_options_from_sheet(_conn: gspread.Client, range_name: str):
             
         return options
         
-    except gspread.exceptions.WorksheetNotFound:
-        st.error("Error crítico: No se encontró la hoja 'LISTAS'.")
+    except gspread.exceptions.APIError as e:
+        # values_get sobre una hoja inexistente responde 400 "Unable to parse range"
+        if "Unable to parse range" in str(e):
+            st.error("Error crítico: No se encontró la hoja 'LISTAS'.")
+        else:
+            st.error(f"Error al cargar la lista {range_name}: {e}")
         return []
     except Exception as e:
         # Mostramos un error más detallado
@@ -47,11 +118,10 @@ def validate_data(sheet_name: str, data: dict):
     Revisa los datos del formulario contra las reglas de FORM_CONFIG.
     Devuelve (True, "") si es válido, o (False, "mensaje de error") si no.
     """
-    fields = FORM_CONFIG.get(sheet_name, {})
+    fields = SCHEMA_PLANS.get(sheet_name, EMPTY_SCHEMA_PLAN)["fields"]
     
     for field_name, value in data.items():
-        config = fields.get(field_name, {})
-        validation_rule = config.get("validate")
+        validation_rule = fields.get(field_name, {}).get("validate")
         
         # --- Reglas de validación personalizadas ---
         
@@ -88,12 +158,12 @@ def validate_data(sheet_name: str, data: dict):
 # --- ESTRUCTURA DE TODOS LOS FORMULARIOS ---
 # Basado en la lista que proporcionaste.
 # 'type' define el widget de Streamlit.
-# 'options' define las opciones estáticas o dinámicas (con lambda).
+# 'options' define las opciones estáticas (lista) o dinámicas (listas_options, rango de LISTAS).
 # 'validate' apunta a una regla en la función validate_data.
 
 FORM_CONFIG = {
     "DOTACION": {
-        "GRADO": {"type": "select", "options": lambda conn: get_options_from_sheet(conn, "K1:K17")},
+        "GRADO": {"type": "select", "options": listas_options("K1:K17")},
         "APELLIDOS": {"type": "text"},
         "NOMBRES": {"type": "text"},
         "CRED.": {"type": "text", "validate": "cedula"},
@@ -118,7 +188,7 @@ FORM_CONFIG = {
         "FECHA CASAM.": {"type": "date"},
         # --- FIN DEL CAMBIO ---
         "DEST. ANT. UNIDAD": {"type": "text"},
-        "ESCALAFON": {"type": "select", "options": lambda conn: get_options_from_sheet(conn, "N1:N19")},
+        "ESCALAFON": {"type": "select", "options": listas_options("N1:N19")},
         "PROFESION": {"type": "text"},
         "DOMICILIO": {"type": "text"},
         "LOCALIDAD": {"type": "text"},
@@ -135,9 +205,9 @@ FORM_CONFIG = {
     "FUNCIONES": {
         "EXPEDIENTE": {"type": "text", "max_chars": 40},
         "CRED.": {"type": "text", "validate": "cedula"},
-        "JEFATURA / DIRECCION": {"type": "select", "options": lambda conn: get_options_from_sheet(conn, "A1:A89")},
-        "DIVISION / DEPARTAMENTO": {"type": "select", "options": lambda conn: get_options_from_sheet(conn, "B1:B89")},
-        "SECCION": {"type":  "select", "options": lambda conn: get_options_from_sheet(conn, "C1:C89")},
+        "JEFATURA / DIRECCION": {"type": "select", "options": listas_options("A1:A89")},
+        "DIVISION / DEPARTAMENTO": {"type": "select", "options": listas_options("B1:B89")},
+        "SECCION": {"type":  "select", "options": listas_options("C1:C89")},
         "CARGO": {"type": "text"},
         "FUNCION DEL B.P.N 700": {"type": "text"},
         "ORDEN INTERNA": {"type": "text"},
@@ -185,7 +255,7 @@ FORM_CONFIG = {
     "LICENCIAS": {
         "EXPEDIENTE": {"type": "text", "max_chars": 40},
         "CRED.": {"type": "text", "validate": "cedula"},
-        "TIPO DE LICENCIA": {"type": "select", "options": lambda conn: get_options_from_sheet(conn, "E1:E30")},
+        "TIPO DE LICENCIA": {"type": "select", "options": listas_options("E1:E30")},
         "DIAS": {"type": "text", "validate": "numeric"},
         "DESDE": {"type": "date"},
         # --- ¡CAMBIO AQUÍ! ---
@@ -259,7 +329,7 @@ FORM_CONFIG = {
         "FECHA": {"type": "date"},
         "HORA DE DEBIA INGRESAR": {"type": "time"},
         "HORA QUE INGRESO": {"type": "time"},
-        "N° DE IMPUNTUALIDAD": {"type": "select", "options": lambda conn: get_options_from_sheet(conn, "I2:I16")},
+        "N° DE IMPUNTUALIDAD": {"type": "select", "options": listas_options("I2:I16")},
     },
     "COMPLEMENTO DE HABERES": {
         "EXPEDIENTE": {"type": "text", "max_chars": 40},
@@ -282,7 +352,7 @@ FORM_CONFIG = {
         "EXPEDIENTE": {"type": "text", "max_chars": 40},
         "CRED.": {"type": "text", "validate": "cedula"},
         "FECHA DE LA FALTA": {"type": "date"}, # Asumo fecha
-        "N° FALTA CON/SIN AVISO": {"type": "select", "options": lambda conn: get_options_from_sheet(conn, "V1:V20")},
+        "N° FALTA CON/SIN AVISO": {"type": "select", "options": listas_options("V1:V20")},
     },
     "PASAJES": {
         "EXPEDIENTE": {"type": "text", "max_chars": 40},
@@ -331,3 +401,97 @@ FORM_CONFIG = {
         # Esta hoja no estaba en tu lista de CAMPOS_DE_FORMULARIOS
     },
 }
+
+# --- PLAN DE ESQUEMA POR HOJA ---
+# FORM_CONFIG se compila una sola vez (al importar) en un plan por hoja:
+# tipo destino de cada columna, la expresión que la convierte desde el texto
+# de Sheets, el dominio de los select y las columnas de vista. La carga, el
+# camino de escritura y validate_data leen de acá en vez de recorrer FORM_CONFIG.
+# Los select quedan en "categoricals" con su dominio fijo (None si sale de LISTAS).
+NUMERIC_VALIDATORS = ["numeric", "max_30", "rango_1_4", "cedula", "dni"]
+_KIND_DTYPES = {"date": pl.Date, "int": pl.Int64}
+# Plan de una hoja sin configuración (no se modifica: se copia)
+EMPTY_SCHEMA_PLAN = {"fields": {}, "casts": {}, "categoricals": {}, "view": []}
+
+def parse_expression(kind, expr):
+    """Conversión desde texto formateado (lo que devuelve Sheets por defecto) al tipo 'kind'."""
+    # --- Conversión de FECHAS ---
+    if kind == "date":
+        # Intentamos parsear DD/MM/YYYY. Si falla, queda null (strict=False)
+        return expr.str.strptime(pl.Date, "%d/%m/%Y", strict=False)
+    # --- Conversión de NUMÉRICOS ---
+    if kind == "int":
+        # Limpiamos puntos y comas para que "30.000" sea 30000 y casteamos
+        return expr.str.replace_all(r"[.,]", "").str.strip_chars().cast(pl.Int64, strict=False)
+    return expr
+
+def _field_kind(config):
+    if config.get("type") == "date":
+        return "date"
+    if config.get("validate") in NUMERIC_VALIDATORS:
+        return "int"
+    return None
+
+def _compile_field(config):
+    options = config.get("options")
+    if isinstance(options, list):
+        domain, domain_source = list(options), "static"
+    elif callable(options):
+        # El dominio se resuelve con la foto de LISTAS; acá solo queda de dónde sale
+        domain, domain_source = None, f"{LISTAS_SHEET_NAME}!{getattr(options, 'range_name', '?')}"
+    else:
+        domain, domain_source = None, None
+    kind = _field_kind(config)
+    return {
+        "type": config.get("type", "text"),
+        "kind": kind,
+        "dtype": _KIND_DTYPES.get(kind, pl.String),
+        "validate": config.get("validate"),
+        "domain": domain,
+        "domain_source": domain_source,
+    }
+
+def compile_schema_plans():
+    """
+    Compila FORM_CONFIG en {hoja: {"fields", "casts", "categoricals", "view"}}.
+    'casts' trae la expresión de conversión ya armada solo para las columnas con tipo.
+    'view' queda vacío: las columnas de vista se agregan con with_view_columns().
+    """
+    plans = {}
+    for sheet_name, config in FORM_CONFIG.items():
+        fields = {name: _compile_field(field_config) for name, field_config in config.items()}
+        typed = {name: field for name, field in fields.items() if field["kind"]}
+        plans[sheet_name] = {
+            "fields": fields,
+            "casts": {name: parse_expression(field["kind"], pl.col(name)) for name, field in typed.items()},
+            "categoricals": {name: field["domain"] for name, field in fields.items() if field["type"] == "select"},
+            "view": [],
+        }
+    return plans
+
+def with_view_columns(plans: dict, vista_columns: dict):
+    """Copia de 'plans' con las columnas de vista de cada hoja (las hojas sin plan reciben EMPTY_SCHEMA_PLAN)."""
+    return {
+        sheet_name: {**plans.get(sheet_name, EMPTY_SCHEMA_PLAN), "view": list(vista_columns.get(sheet_name, []))}
+        for sheet_name in dict.fromkeys([*plans, *vista_columns])
+    }
+
+def dump_schema_plans(plans: dict):
+    """Plan en JSON legible (tipos y expresiones como texto), para inspección."""
+    readable = {
+        sheet_name: {
+            "view": plan["view"],
+            "fields": {
+                name: {**field, "dtype": str(field["dtype"]), "cast": str(plan["casts"][name]) if name in plan["casts"] else None}
+                for name, field in plan["fields"].items()
+            },
+        }
+        for sheet_name, plan in plans.items()
+    }
+    return json.dumps(readable, ensure_ascii=False, indent=2)
+
+# Plan sin columnas de vista (las define app.py): alcanza para validate_data
+SCHEMA_PLANS = compile_schema_plans()
+
+if __name__ == "__main__":
+    print(dump_schema_plans(SCHEMA_PLANS))
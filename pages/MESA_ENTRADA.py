@@ -12,8 +12,9 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 try:
     from form_config import GOOGLE_SHEET_ID
+    from sheets_api import QuotaAwareHTTPClient, get_spreadsheet, get_worksheet
 except ImportError:
-    st.error("No se pudo encontrar 'form_config.py' en el directorio padre.")
+    st.error("No se pudo encontrar 'form_config.py' o 'sheets_api.py' en el directorio padre.")
     st.stop()
 
 # --- CONFIGURACIÓN DE LA PÁGINA ---
@@ -64,7 +65,7 @@ def get_gspread_client():
             return None
     
     try:
-        return gspread.service_account_from_dict(creds_dict, scopes=SCOPES)
+        return gspread.service_account_from_dict(creds_dict, scopes=SCOPES, http_client=QuotaAwareHTTPClient)
     except Exception as e:
         st.error(f"Error de autenticación: {e}")
         st.stop()
@@ -130,10 +131,10 @@ if st.button("🚀 Procesar y Subir a 'MESA_ENTRADA'", type="primary"):
                 filas_nuevas = df_final.height
                 
                 # --- PREPARACIÓN DE GOOGLE SHEETS ---
-                sh = gc.open_by_key(GOOGLE_SHEET_ID)
+                sh = get_spreadsheet(gc, GOOGLE_SHEET_ID)
                 
                 try:
-                    worksheet = sh.worksheet(SHEET_NAME)
+                    worksheet = get_worksheet(sh, SHEET_NAME)
                 except gspread.WorksheetNotFound:
                     st.error(f"❌ No se encontró la hoja '{SHEET_NAME}'. Por favor créala en el Google Sheet.")
                     st.stop()
@@ -169,9 +170,9 @@ if st.button("👁️ Cargar y Ver Datos de MESA_ENTRADA"):
     if gc:
         try:
             with st.spinner("Descargando datos de Google Sheets..."):
-                sh = gc.open_by_key(GOOGLE_SHEET_ID)
+                sh = get_spreadsheet(gc, GOOGLE_SHEET_ID)
                 try:
-                    worksheet = sh.worksheet(SHEET_NAME)
+                    worksheet = get_worksheet(sh, SHEET_NAME)
                 except gspread.WorksheetNotFound:
                     st.error(f"❌ No se encontró la hoja '{SHEET_NAME}'.")
                     st.stop()
@@ -7,6 +7,8 @@ from dotenv import load_dotenv # Para cargar el .env local
 import xlsxwriter
 from io import BytesIO
 import datetime
+from sheets_api import QuotaAwareHTTPClient, get_spreadsheet, get_range_values, clear_range_cache # Cuota, reintentos, handles y rangos compartidos con la app
+from form_config import HOJA_PARTE_DIARIO, RANGOS_PARTE_DIARIO # Rangos que también precarga el refresco de fondo
 
 # Cargar variables de entorno locales (del archivo .env)
 load_dotenv()
@@ -65,7 +67,7 @@ def get_gspread_client():
         
         # --- CORRECCIÓN DE AUTENTICACIÓN ---
         # Los scopes se pasan como argumento, no con .with_scopes()
-        client = gspread.service_account_from_dict(creds_dict, scopes=SCOPES)
+        client = gspread.service_account_from_dict(creds_dict, scopes=SCOPES, http_client=QuotaAwareHTTPClient)
         # --- FIN CORRECCIÓN ---
         
         return client
@@ -90,7 +92,7 @@ def get_spreadsheet_connection():
             return None
         
         # --- CAMBIO IMPORTANTE: Abrir por ID ---
-        sh = gc.open_by_key(GOOGLE_SHEET_ID)
+        sh = get_spreadsheet(gc, GOOGLE_SHEET_ID)
         # --- FIN DEL CAMBIO ---
         
         return sh
@@ -102,16 +104,15 @@ def get_spreadsheet_connection():
         return None
 
 # --- FUNCIÓN DE CARGA DE DATOS (MÉTODO 1) ---
-@st.cache_data(ttl=600)
-def load_pivot_range(_sh, sheet_name, data_range): # <- CAMBIO AQUÍ
+def load_pivot_range(_sh, sheet_name, data_range):
     """
     Lee un rango específico de una hoja de cálculo.
     '_sh' es la conexión ya abierta (Spreadsheet).
-    Streamlit ignora los argumentos con '_' al cachear.
+    Los valores salen de la caché de rangos del proceso (sheets_api), que el
+    refresco de fondo de la app mantiene al día; solo se llama a la API si vencieron.
     """
     try:
-        worksheet = _sh.worksheet(sheet_name) # <- CAMBIO AQUÍ
-        data = worksheet.get_values(data_range)
+        data = get_range_values(_sh, sheet_name, data_range)
         
         if not data:
             st.warning(f"No se encontraron datos en el rango {data_range} de la hoja {sheet_name}")
@@ -121,8 +122,12 @@ def load_pivot_range(_sh, sheet_name, data_range): # <- CAMBIO AQUÍ
         df = pl.DataFrame(data[1:], schema=data[0], orient="row")
         return df
 
-    except gspread.exceptions.WorksheetNotFound:
-        st.error(f"Error: No se encontró la hoja llamada '{sheet_name}'. Revisa los nombres.")
+    except gspread.exceptions.APIError as e:
+        # values_get sobre una hoja inexistente responde 400 "Unable to parse range"
+        if "Unable to parse range" in str(e):
+            st.error(f"Error: No se encontró la hoja llamada '{sheet_name}'. Revisa los nombres.")
+        else:
+            st.error(f"Error al leer el rango '{data_range}': {e}")
         return None
     except Exception as e:
         st.error(f"Error al leer el rango '{data_range}': {e}")
@@ -201,9 +206,8 @@ st.markdown("---")
 
 # Botón de recarga
 if st.button("Recargar Datos"):
-    # Limpiar todos los cachés de datos y recursos
-    st.cache_data.clear()
-    st.cache_resource.clear()
+    # Limpiar solo los rangos cacheados (el cliente y las hojas de la app siguen en caché)
+    clear_range_cache()
     st.toast("Forzando recarga de datos...")
     st.rerun()
 
@@ -216,8 +220,8 @@ if sh:
     st.header("RECUENTO GENERAL")
     
     # Define la hoja y rango para la primera tabla
-    HOJA_RECUENTO = "Tabla dinámica 1"
-    RANGO_RECUENTO = "A2:E5" # Ajusta este rango
+    HOJA_RECUENTO = HOJA_PARTE_DIARIO
+    RANGO_RECUENTO = RANGOS_PARTE_DIARIO["RECUENTO"]
     
     df_recuento = load_pivot_range(sh, HOJA_RECUENTO, RANGO_RECUENTO)
     
@@ -229,8 +233,8 @@ if sh:
     st.header("Oficiales")
     
     # Define la hoja y rango para la segunda tabla
-    HOJA_OFICIALES = "Tabla dinámica 1"
-    RANGO_OFICIALES = "A7:E22" # ¡¡AJUSTA ESTE RANGO!!
+    HOJA_OFICIALES = HOJA_PARTE_DIARIO
+    RANGO_OFICIALES = RANGOS_PARTE_DIARIO["OFICIALES"]
     
     df_oficiales = load_pivot_range(sh, HOJA_OFICIALES, RANGO_OFICIALES)
     
@@ -240,24 +244,24 @@ if sh:
         
     # --- 3. PUEDES AGREGAR OTRA TABLA AQUÍ ---
     st.header("Suboficiales")
-    HOJA_SUBOFICIALES = "Tabla dinámica 1"
-    RANGO_SUBOFICIALES = "A25:E32"
+    HOJA_SUBOFICIALES = HOJA_PARTE_DIARIO
+    RANGO_SUBOFICIALES = RANGOS_PARTE_DIARIO["SUBOFICIALES"]
     df_suboficiales = load_pivot_range(sh, HOJA_SUBOFICIALES, RANGO_SUBOFICIALES)
     if df_suboficiales is not None:
         st.dataframe(df_suboficiales, hide_index=True, width='stretch')
     
     # --- 4. PENDIENTES DE PRESENTACION ---
     st.header("Pendientes de Presentación")
-    HOJA_PENDIENTE_DE_PRESENTACION = "Tabla dinámica 1"
-    RANGO_PENDIENTE_DE_PRESENTACION = "G2:L"
+    HOJA_PENDIENTE_DE_PRESENTACION = HOJA_PARTE_DIARIO
+    RANGO_PENDIENTE_DE_PRESENTACION = RANGOS_PARTE_DIARIO["PENDIENTE_DE_PRESENTACION"]
     df_pendient_de_presentacion = load_pivot_range(sh, HOJA_PENDIENTE_DE_PRESENTACION, RANGO_PENDIENTE_DE_PRESENTACION)
     if df_pendient_de_presentacion is not None:
         st.dataframe(df_pendient_de_presentacion, hide_index=True, width='stretch')
 
     # --- 5. PENDIENTES DE NOTIFICACION ---
     st.header("Pendientes de Notificacón")
-    HOJA_PENDIENTE_DE_NOTIFICACION = "Tabla dinámica 1"
-    RANGO_PENDIENTE_DE_NOTIFICACION = "M2:R"
+    HOJA_PENDIENTE_DE_NOTIFICACION = HOJA_PARTE_DIARIO
+    RANGO_PENDIENTE_DE_NOTIFICACION = RANGOS_PARTE_DIARIO["PENDIENTE_DE_NOTIFICACION"]
     df_pendient_de_notificacion = load_pivot_range(sh, HOJA_PENDIENTE_DE_NOTIFICACION, RANGO_PENDIENTE_DE_NOTIFICACION)
     if df_pendient_de_notificacion is not None:
         st.dataframe(df_pendient_de_notificacion, hide_index=True, width='stretch')
@@ -265,8 +269,8 @@ if sh:
 
     # --- 6. RECUENTTO DE INASITENCIAS ---
     st.header("Recuento de Inasistencias")
-    HOJA_RECUENTO_DE_INASISTENCIAS = "Tabla dinámica 1"
-    RANGO_RECUENTO_DE_INASISTENCIAS = "T2:V"
+    HOJA_RECUENTO_DE_INASISTENCIAS = HOJA_PARTE_DIARIO
+    RANGO_RECUENTO_DE_INASISTENCIAS = RANGOS_PARTE_DIARIO["RECUENTO_DE_INASISTENCIAS"]
     df_recuento_de_inasistencias = load_pivot_range(sh, HOJA_RECUENTO_DE_INASISTENCIAS, RANGO_RECUENTO_DE_INASISTENCIAS)
     if df_recuento_de_inasistencias is not None:
         st.dataframe(df_recuento_de_inasistencias, hide_index=True, width='stretch')
@@ -274,8 +278,8 @@ if sh:
 
     # --- 7. PARTE DE ENFERMO ---
     st.header("Parte de Enfermo")
-    HOJA_PARTE_DE_ENFERMO = "Tabla dinámica 1"
-    RANGO_PARTE_DE_ENFERMO = "Y2:AF"
+    HOJA_PARTE_DE_ENFERMO = HOJA_PARTE_DIARIO
+    RANGO_PARTE_DE_ENFERMO = RANGOS_PARTE_DIARIO["PARTE_DE_ENFERMO"]
     df_parte_de_enfermo = load_pivot_range(sh, HOJA_PARTE_DE_ENFERMO, RANGO_PARTE_DE_ENFERMO)
     if df_parte_de_enfermo is not None:
         st.dataframe(df_parte_de_enfermo, hide_index=True, width='stretch')
@@ -283,64 +287,64 @@ if sh:
 
     # --- 8. PARTE DE ASISTENCIA FAMILIAR ---
     st.header("Parte de Asistencia Familiar")
-    HOJA_PARTE_DE_ASISTENCIA_FAMILIAR = "Tabla dinámica 1"
-    RANGO_PARTE_DE_ASISTENCIA_FAMILIAR = "AJ2:AP"
+    HOJA_PARTE_DE_ASISTENCIA_FAMILIAR = HOJA_PARTE_DIARIO
+    RANGO_PARTE_DE_ASISTENCIA_FAMILIAR = RANGOS_PARTE_DIARIO["PARTE_DE_ASISTENCIA_FAMILIAR"]
     df_parte_de_asistencia_familiar = load_pivot_range(sh, HOJA_PARTE_DE_ASISTENCIA_FAMILIAR, RANGO_PARTE_DE_ASISTENCIA_FAMILIAR)
     if df_parte_de_asistencia_familiar is not None:
         st.dataframe(df_parte_de_asistencia_familiar, hide_index=True, width='stretch')
 
     # --- 9. ACCIDENTE DE SERVICIO ---
     st.header("Accidente de Servicio")
-    HOJA_ACCIDENTE_DE_SERVICIO = "Tabla dinámica 1"
-    RANGO_ACCIDENTE_DE_SERVICIO = "AS2:AZ"
+    HOJA_ACCIDENTE_DE_SERVICIO = HOJA_PARTE_DIARIO
+    RANGO_ACCIDENTE_DE_SERVICIO = RANGOS_PARTE_DIARIO["ACCIDENTE_DE_SERVICIO"]
     df_accidente_de_servicio = load_pivot_range(sh, HOJA_ACCIDENTE_DE_SERVICIO, RANGO_ACCIDENTE_DE_SERVICIO)
     if df_accidente_de_servicio is not None:
         st.dataframe(df_accidente_de_servicio, hide_index=True, width='stretch')
 
     # --- 10. CAPACIDAD LABORAL ---
     st.header("Capacidad Laboral")
-    HOJA_CAPACIDAD_LABORAL = "Tabla dinámica 1"
-    RANGO_CAPACIDAD_LABORAL = "BC2:BJ"
+    HOJA_CAPACIDAD_LABORAL = HOJA_PARTE_DIARIO
+    RANGO_CAPACIDAD_LABORAL = RANGOS_PARTE_DIARIO["CAPACIDAD_LABORAL"]
     df_capacidad_laboral = load_pivot_range(sh, HOJA_CAPACIDAD_LABORAL, RANGO_CAPACIDAD_LABORAL)
     if df_capacidad_laboral is not None:
         st.dataframe(df_capacidad_laboral, hide_index=True, width='stretch')
 
     # --- 11. DISPONIBILIDAD ---
     st.header("Disponibilidad")
-    HOJA_DISPONIBILIDAD = "Tabla dinámica 1"
-    RANGO_DISPONIBILIDAD = "BN2:BU"
+    HOJA_DISPONIBILIDAD = HOJA_PARTE_DIARIO
+    RANGO_DISPONIBILIDAD = RANGOS_PARTE_DIARIO["DISPONIBILIDAD"]
     df_disponibilidad = load_pivot_range(sh, HOJA_DISPONIBILIDAD, RANGO_DISPONIBILIDAD)
     if df_disponibilidad is not None:
         st.dataframe(df_disponibilidad, hide_index=True, width='stretch')
 
     # --- 12. RENUNCIA ---
     st.header("Renuncia")
-    HOJA_RENUNCIA = "Tabla dinámica 1"
-    RANGO_RENUNCIA = "BZ2:CF"
+    HOJA_RENUNCIA = HOJA_PARTE_DIARIO
+    RANGO_RENUNCIA = RANGOS_PARTE_DIARIO["RENUNCIA"]
     df_renuncia = load_pivot_range(sh, HOJA_RENUNCIA, RANGO_RENUNCIA)
     if df_renuncia is not None:
         st.dataframe(df_renuncia, hide_index=True, width='stretch')
 
     # --- 13. FALLECIMIENTO ---
     st.header("Fallecimiento")
-    HOJA_FALLECIMIENTO = "Tabla dinámica 1"
-    RANGO_FALLECIMIENTO = "CK2:CQ"
+    HOJA_FALLECIMIENTO = HOJA_PARTE_DIARIO
+    RANGO_FALLECIMIENTO = RANGOS_PARTE_DIARIO["FALLECIMIENTO"]
     df_fallecimiento = load_pivot_range(sh, HOJA_FALLECIMIENTO, RANGO_FALLECIMIENTO)
     if df_fallecimiento is not None:
         st.dataframe(df_fallecimiento, hide_index=True, width='stretch')
 
     # --- 14. SUSPENSIÓN PREVENTIVA ---
     st.header("Suspensión Preventiva")
-    HOJA_SUSPENSION_PREVENTIVA = "Tabla dinámica 1"
-    RANGO_SUSPENSION_PREVENTIVA = "CV2:DA"
+    HOJA_SUSPENSION_PREVENTIVA = HOJA_PARTE_DIARIO
+    RANGO_SUSPENSION_PREVENTIVA = RANGOS_PARTE_DIARIO["SUSPENSION_PREVENTIVA"]
     df_suspension_preventiva = load_pivot_range(sh, HOJA_SUSPENSION_PREVENTIVA, RANGO_SUSPENSION_PREVENTIVA)
     if df_suspension_preventiva is not None:
         st.dataframe(df_suspension_preventiva, hide_index=True, width='stretch')
 
     # --- 15. INASISTENCIA INJUSTIFICADA ---
     st.header("Inasistencia Injustificada")
-    HOJA_INASISTENCIA_INJUSTIFICADA = "Tabla dinámica 1"
-    RANGO_INASISTENCIA_INJUSTIFICADA = "DG2:DL"
+    HOJA_INASISTENCIA_INJUSTIFICADA = HOJA_PARTE_DIARIO
+    RANGO_INASISTENCIA_INJUSTIFICADA = RANGOS_PARTE_DIARIO["INASISTENCIA_INJUSTIFICADA"]
     df_inasistencia_injustificada = load_pivot_range(sh, HOJA_INASISTENCIA_INJUSTIFICADA, RANGO_INASISTENCIA_INJUSTIFICADA)
     if df_inasistencia_injustificada is not None:
         st.dataframe(df_inasistencia_injustificada, hide_index=True, width='stretch')
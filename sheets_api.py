@@ -0,0 +1,380 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http import HTTPStatus
+
+import requests
+from gspread.exceptions import APIError, WorksheetNotFound
+from gspread.http_client import HTTPClient
+from gspread.utils import absolute_range_name, fill_gaps
+
+# --- CAPA COMPARTIDA DE ACCESO A LA API DE GOOGLE SHEETS ---
+# Todas las llamadas de gspread (app, páginas y form_config) pasan por
+# QuotaAwareHTTPClient: un único token bucket por proceso dimensionado a la
+# cuota por minuto de la cuenta de servicio, reintentos con jitter ante
+# 429/5xx y prioridad para las lecturas interactivas sobre las de fondo.
+
+# Cuota de Sheets por minuto y por usuario (cuenta de servicio). Ajustable por entorno.
+SHEETS_QUOTA_POR_MINUTO = int(os.environ.get("SHEETS_QUOTA_POR_MINUTO", "60"))
+# Fracción del bucket que las tareas de fondo no pueden consumir (queda para los usuarios)
+RESERVA_INTERACTIVA = 0.25
+MAX_REINTENTOS = 5
+BACKOFF_BASE_SEGUNDOS = 1.0
+BACKOFF_MAX_SEGUNDOS = 32.0
+
+PRIORIDAD_INTERACTIVA = "interactiva"
+PRIORIDAD_FONDO = "fondo"
+
+_RETRYABLE_CODES = {HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.REQUEST_TIMEOUT}
+_priority = threading.local()
+
+
+@contextmanager
+def background_priority():
+    """Marca las llamadas del hilo actual como de fondo (ceden el paso a las interactivas)."""
+    previous = getattr(_priority, "value", PRIORIDAD_INTERACTIVA)
+    _priority.value = PRIORIDAD_FONDO
+    try:
+        yield
+    finally:
+        _priority.value = previous
+
+
+def _current_priority():
+    return getattr(_priority, "value", PRIORIDAD_INTERACTIVA)
+
+
+class _TokenBucket:
+    """Token bucket con prioridad: las tareas de fondo no bajan de la reserva ni se adelantan a un usuario en espera."""
+
+    def __init__(self, per_minute, reserve_fraction):
+        self.capacity = float(per_minute)
+        self.refill_per_second = per_minute / 60.0
+        self.reserve = self.capacity * reserve_fraction
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waiting_interactive = 0
+        self.cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def acquire(self, priority):
+        """Bloquea hasta obtener un token. Devuelve los segundos esperados."""
+        background = priority == PRIORIDAD_FONDO
+        start = time.monotonic()
+        with self.cond:
+            if not background:
+                self.waiting_interactive += 1
+            try:
+                while True:
+                    self._refill()
+                    floor = self.reserve if background else 0.0
+                    can_go = not background or self.waiting_interactive == 0
+                    if can_go and self.tokens >= floor + 1:
+                        self.tokens -= 1
+                        return time.monotonic() - start
+                    missing = max(floor + 1 - self.tokens, 0.0)
+                    self.cond.wait(timeout=max(missing / self.refill_per_second, 0.05))
+            finally:
+                if not background:
+                    self.waiting_interactive -= 1
+                    self.cond.notify_all()
+
+    def available(self):
+        with self.cond:
+            self._refill()
+            return self.tokens
+
+
+_BUCKET = _TokenBucket(SHEETS_QUOTA_POR_MINUTO, RESERVA_INTERACTIVA)
+
+_stats_lock = threading.Lock()
+_STATS = {
+    "requests": 0,
+    "requests_fondo": 0,
+    "reintentos": 0,
+    "errores_429": 0,
+    "errores_5xx": 0,
+    "esperas": 0,
+    "segundos_espera": 0.0,
+    "coalescidas": 0,
+}
+_ULTIMO_MINUTO = deque()
+
+
+def _record_request(priority, waited):
+    now = time.monotonic()
+    with _stats_lock:
+        _STATS["requests"] += 1
+        if priority == PRIORIDAD_FONDO:
+            _STATS["requests_fondo"] += 1
+        if waited > 0.01:
+            _STATS["esperas"] += 1
+            _STATS["segundos_espera"] += waited
+        _ULTIMO_MINUTO.append(now)
+        while _ULTIMO_MINUTO and now - _ULTIMO_MINUTO[0] > 60:
+            _ULTIMO_MINUTO.popleft()
+
+
+def _record_error(code):
+    with _stats_lock:
+        _STATS["reintentos"] += 1
+        if code == HTTPStatus.TOO_MANY_REQUESTS:
+            _STATS["errores_429"] += 1
+        elif code and code >= HTTPStatus.INTERNAL_SERVER_ERROR:
+            _STATS["errores_5xx"] += 1
+
+
+def get_quota_stats():
+    """Contadores del proceso: uso del último minuto frente a la cuota, reintentos y esperas."""
+    now = time.monotonic()
+    with _stats_lock:
+        while _ULTIMO_MINUTO and now - _ULTIMO_MINUTO[0] > 60:
+            _ULTIMO_MINUTO.popleft()
+        stats = dict(_STATS)
+        stats["ultimo_minuto"] = len(_ULTIMO_MINUTO)
+    stats["limite_por_minuto"] = SHEETS_QUOTA_POR_MINUTO
+    stats["uso_cuota"] = stats["ultimo_minuto"] / SHEETS_QUOTA_POR_MINUTO if SHEETS_QUOTA_POR_MINUTO else 0.0
+    stats["tokens_disponibles"] = _BUCKET.available()
+    return stats
+
+
+def _backoff_seconds(attempt):
+    """Backoff exponencial con 'full jitter' para que varias sesiones no reintenten a la vez."""
+    return random.uniform(0, min(BACKOFF_MAX_SEGUNDOS, BACKOFF_BASE_SEGUNDOS * 2 ** attempt))
+
+
+class QuotaAwareHTTPClient(HTTPClient):
+    """
+    HTTPClient de gspread que pide un token antes de cada request y reintenta
+    ante 429, 408 y 5xx. Las escrituras (POST/PUT) solo se reintentan ante
+    429/408, porque un 5xx no garantiza que el cambio no se haya aplicado.
+    Se usa con: gspread.service_account_from_dict(..., http_client=QuotaAwareHTTPClient)
+    """
+
+    def request(self, method, endpoint, *args, **kwargs):
+        priority = _current_priority()
+        is_read = method.lower() == "get"
+        attempt = 0
+        while True:
+            waited = _BUCKET.acquire(priority)
+            _record_request(priority, waited)
+            try:
+                return super().request(method, endpoint, *args, **kwargs)
+            except APIError as e:
+                code = e.code
+                retryable = code in _RETRYABLE_CODES or (is_read and code >= HTTPStatus.INTERNAL_SERVER_ERROR)
+                if not retryable or attempt >= MAX_REINTENTOS:
+                    raise
+                _record_error(code)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if not is_read or attempt >= MAX_REINTENTOS:
+                    raise
+                _record_error(None)
+            time.sleep(_backoff_seconds(attempt))
+            attempt += 1
+
+
+# --- SINGLE-FLIGHT: UNA SOLA DESCARGA POR CLAVE A LA VEZ ---
+# Cuando varias sesiones piden la misma hoja o rango al mismo tiempo (cambio
+# de turno), solo la primera llama a la API; el resto espera ese resultado.
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_inflight_lock = threading.Lock()
+_INFLIGHT = {}
+
+
+def single_flight(key, fn, *args, **kwargs):
+    """
+    Ejecuta fn(*args, **kwargs) salvo que ya haya una llamada en curso con la
+    misma 'key'; en ese caso espera y devuelve (o relanza) el resultado de esa
+    llamada. No guarda nada una vez terminada: el cacheo queda a cargo de quien llama.
+    """
+    with _inflight_lock:
+        flight = _INFLIGHT.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Flight()
+            _INFLIGHT[key] = flight
+
+    if not leader:
+        with _stats_lock:
+            _STATS["coalescidas"] += 1
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = fn(*args, **kwargs)
+        return flight.result
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _inflight_lock:
+            _INFLIGHT.pop(key, None)
+        flight.done.set()
+
+
+def claim_flights(keys):
+    """
+    Reserva las claves de 'keys' que nadie está resolviendo y devuelve la lista
+    de las reservadas. Mientras tanto, single_flight con una de esas claves espera
+    su resultado; cada una debe cerrarse con resolve_flight(), también ante un error.
+    """
+    with _inflight_lock:
+        claimed = [key for key in dict.fromkeys(keys) if key not in _INFLIGHT]
+        for key in claimed:
+            _INFLIGHT[key] = _Flight()
+    return claimed
+
+
+def resolve_flight(key, result=None, error=None):
+    """Publica el resultado (o el error) de una clave reservada con claim_flights y la libera."""
+    with _inflight_lock:
+        flight = _INFLIGHT.pop(key)
+    flight.result = result
+    flight.error = error
+    flight.done.set()
+
+
+def single_flight_many(keys, fn):
+    """
+    single_flight para varias claves con una sola llamada: fn(claves) se ejecuta
+    solo con las claves que nadie está resolviendo y debe devolver {clave: resultado}
+    con todas ellas. Quien espere una de esas claves con single_flight recibe su
+    resultado. Las claves que ya estaban en curso se omiten (las completa su dueño).
+    Devuelve lo que devolvió fn ({} si no quedó ninguna clave).
+    """
+    claimed = claim_flights(keys)
+    if not claimed:
+        return {}
+
+    try:
+        results = fn(claimed)
+    except BaseException as e:
+        for key in claimed:
+            resolve_flight(key, error=e)
+        raise
+    for key in claimed:
+        if key in results:
+            resolve_flight(key, result=results[key])
+        else:
+            resolve_flight(key, error=KeyError(key))
+    return results
+
+
+# --- REGISTRO DE HANDLES (SPREADSHEET Y WORKSHEETS) ---
+# open_by_key() y sh.worksheet() cuestan una lectura de metadatos cada vez.
+# El registro abre la planilla una sola vez por proceso y arma el mapa
+# título → Worksheet con una única llamada a worksheets(); ese mapa solo se
+# vuelve a pedir cuando se busca un título que no está (hoja nueva o renombrada).
+
+_registry_lock = threading.Lock()
+_SPREADSHEETS = {}
+_WORKSHEETS = {}
+
+
+def _open_spreadsheet(gc, key):
+    sh = gc.open_by_key(key)
+    with _registry_lock:
+        _SPREADSHEETS[key] = sh
+    return sh
+
+
+def get_spreadsheet(gc, key):
+    """Devuelve el Spreadsheet de 'key', abriéndolo solo la primera vez."""
+    sh = _SPREADSHEETS.get(key)
+    if sh is None:
+        sh = single_flight(("spreadsheet", key), _open_spreadsheet, gc, key)
+    return sh
+
+
+def _load_worksheets(sh):
+    worksheets = {ws.title: ws for ws in sh.worksheets()}
+    with _registry_lock:
+        _WORKSHEETS[sh.id] = worksheets
+    return worksheets
+
+
+def get_worksheets(sh, refresh=False):
+    """Mapa título → Worksheet de la planilla (en el orden de las pestañas)."""
+    worksheets = None if refresh else _WORKSHEETS.get(sh.id)
+    if worksheets is None:
+        worksheets = single_flight(("worksheets", sh.id), _load_worksheets, sh)
+    return worksheets
+
+
+def get_worksheet(sh, title):
+    """
+    Devuelve la Worksheet 'title' desde el registro. Si no está, refresca el
+    mapa una vez; si sigue sin estar, lanza WorksheetNotFound como sh.worksheet().
+    """
+    worksheet = get_worksheets(sh).get(title)
+    if worksheet is None:
+        worksheet = get_worksheets(sh, refresh=True).get(title)
+    if worksheet is None:
+        raise WorksheetNotFound(title)
+    return worksheet
+
+
+# --- CACHÉ DE RANGOS DEL PROCESO ---
+# Rangos sueltos (tablas dinámicas del parte diario) compartidos por todas las
+# sesiones. El refresco de fondo los precarga con un único values:batchGet.
+
+RANGOS_TTL_SEGUNDOS = 600
+
+_RANGES = {}
+
+
+def _range_key(sh, sheet_name, data_range):
+    return (sh.id, absolute_range_name(sheet_name, data_range))
+
+
+def _store_range(key, value_range):
+    # Igual que get_values(): rellenamos las filas cortas con ""
+    values = fill_gaps(value_range.get("values", []))
+    _RANGES[key] = (values, time.monotonic())
+    return values
+
+
+def _fetch_range(sh, key):
+    return _store_range(key, sh.values_get(key[1]))
+
+
+def get_range_values(sh, sheet_name, data_range, max_age=RANGOS_TTL_SEGUNDOS):
+    """Valores de 'sheet_name'!'data_range' desde la caché del proceso; los pide a la API si vencieron."""
+    key = _range_key(sh, sheet_name, data_range)
+    cached = _RANGES.get(key)
+    if cached is not None and time.monotonic() - cached[1] < max_age:
+        return cached[0]
+    return single_flight(("rango",) + key, _fetch_range, sh, key)
+
+
+def prefetch_ranges(sh, sheet_name, ranges):
+    """Descarga varios rangos de una hoja con un solo values:batchGet y los deja en la caché."""
+    keys = [_range_key(sh, sheet_name, data_range) for data_range in ranges]
+    if not keys:
+        return
+    response = sh.values_batch_get([key[1] for key in keys])
+    # Google devuelve los rangos en el mismo orden en que se pidieron
+    for key, value_range in zip(keys, response.get("valueRanges", [])):
+        _store_range(key, value_range)
+
+
+def clear_range_cache():
+    """Descarta todos los rangos cacheados (botón de recarga del parte diario)."""
+    _RANGES.clear()